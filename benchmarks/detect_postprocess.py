@@ -0,0 +1,66 @@
+import argparse
+import time
+
+import torch
+
+from src.faceDetector.s3fd.box_utils import Detect, PriorBox
+
+
+def make_inputs(batch_size, height, width, face_ratio, seed=0):
+    """Builds S3FDNet-shaped loc/conf/prior tensors where about face_ratio of the priors pass conf_thresh."""
+    gen = torch.Generator().manual_seed(seed)
+
+    steps = [4, 8, 16, 32, 64, 128]
+    feature_maps = [[-(-height // s), -(-width // s)] for s in steps]
+    priors = PriorBox((height, width), feature_maps).forward()
+    num_priors = priors.size(0)
+
+    loc = torch.randn(batch_size, num_priors, 4, generator=gen) * 0.5
+    logits = torch.randn(batch_size, num_priors, 2, generator=gen)
+    logits[..., 0] += 4.0
+    face = torch.rand(batch_size, num_priors, generator=gen) < face_ratio
+    logits[..., 1] += face * 4.0
+    conf = torch.softmax(logits, dim=-1)
+
+    return loc, conf, priors
+
+
+def time_it(fn, repeats):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        out = fn()
+    return out, (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Detect post-processing benchmark (loop vs batched NMS)")
+    parser.add_argument('--height', type=int, default=270, help='Network input height')
+    parser.add_argument('--width', type=int, default=480, help='Network input width')
+    parser.add_argument('--batchSizes', type=int, nargs='+', default=[1, 4, 8], help='Batch sizes to run')
+    parser.add_argument('--faceRatio', type=float, default=0.05, help='Fraction of priors scoring above conf_thresh')
+    parser.add_argument('--repeats', type=int, default=5, help='Timed runs per configuration')
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op threads (0 = torch default)')
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    loop, fast = Detect(fast=False), Detect(fast=True)
+
+    print(f"input {args.height}x{args.width}, {torch.get_num_threads()} threads")
+    with torch.no_grad():
+        for batch_size in args.batchSizes:
+            loc, conf, priors = make_inputs(batch_size, args.height, args.width, args.faceRatio)
+            candidates = int((conf[..., 1] > loop.conf_thresh).sum())
+
+            out_loop, t_loop = time_it(lambda: loop.forward(loc, conf, priors), args.repeats)
+            out_fast, t_fast = time_it(lambda: fast.forward(loc, conf, priors), args.repeats)
+
+            print(f"batch {batch_size:3d}  candidates {candidates:6d}  "
+                  f"loop {t_loop * 1000:9.2f} ms  fast {t_fast * 1000:8.2f} ms  "
+                  f"speedup {t_loop / t_fast:6.1f}x  identical {torch.equal(out_loop, out_fast)}")
+
+
+if __name__ == '__main__':
+    main()
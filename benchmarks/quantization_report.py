@@ -0,0 +1,93 @@
+import argparse
+import time
+
+import cv2
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from src.faceDetector.s3fd import S3FD
+from src.faceDetector.boxes import iou_matrix
+
+
+def read_frames(video_path, frame_step, max_frames):
+    """Reads every frame_step-th frame of the clip as RGB, at most max_frames of them."""
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise ValueError(f"Could not open video: {video_path}")
+
+    frames = []
+    fidx = 0
+    while len(frames) < max_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if fidx % frame_step == 0:
+            frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        fidx += 1
+    cap.release()
+    return frames
+
+
+def run(detector, frames, args):
+    dets = []
+    start = time.perf_counter()
+    for i in range(0, len(frames), args.batchSize):
+        dets.extend(detector.detect_faces_batch(frames[i:i + args.batchSize], conf_th=args.conf_th,
+                                                scales=[args.facedetScale]))
+    return dets, time.perf_counter() - start
+
+
+def match(ref_dets, test_dets, iou_th):
+    """One-to-one matches the test boxes of each frame to the reference boxes, returns the matched IoUs."""
+    ious = []
+    for ref, test in zip(ref_dets, test_dets):
+        if len(ref) == 0 or len(test) == 0:
+            continue
+        iou = iou_matrix(ref, test)
+        rows, cols = linear_sum_assignment(-iou)
+        matched = iou[rows, cols]
+        ious.extend(matched[matched >= iou_th])
+    return np.array(ious)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare quantized S3FD boxes against the fp32 model on a clip")
+    parser.add_argument('--input_video', type=str, required=True, help='Sample clip')
+    parser.add_argument('--quantize', type=str, default='int8', choices=['int8', 'fp16'], help='Quantized mode to test')
+    parser.add_argument('--device', type=str, default='auto', choices=['auto', 'cpu', 'cuda'], help='Face detection device')
+    parser.add_argument('--facedetScale', type=float, default=0.25, help='Scale factor for face detection')
+    parser.add_argument('--conf_th', type=float, default=0.9, help='Confidence threshold for both models')
+    parser.add_argument('--frameStep', type=int, default=25, help='Use every n-th frame of the clip')
+    parser.add_argument('--maxFrames', type=int, default=200, help='Max frames to compare')
+    parser.add_argument('--calibFrames', type=int, default=16, help='Frames used to calibrate the int8 model')
+    parser.add_argument('--batchSize', type=int, default=8, help='Frames per forward pass')
+    parser.add_argument('--iouTh', type=float, default=0.5, help='IoU for a quantized box to count as a match')
+    args = parser.parse_args()
+
+    frames = read_frames(args.input_video, args.frameStep, args.maxFrames)
+    if not frames:
+        raise ValueError(f"No frames read from {args.input_video}")
+
+    # calibration frames are spread over the whole clip
+    calib = frames[::max(1, len(frames) // args.calibFrames)][:args.calibFrames]
+    device = 'cpu' if args.quantize == 'int8' else args.device
+
+    ref_dets, ref_time = run(S3FD(device=device), frames, args)
+    test_dets, test_time = run(S3FD(device=device, quantize=args.quantize, calibration_images=calib,
+                                    calibration_scale=args.facedetScale), frames, args)
+
+    n_ref = sum(len(d) for d in ref_dets)
+    n_test = sum(len(d) for d in test_dets)
+    ious = match(ref_dets, test_dets, args.iouTh)
+
+    print(f"{len(frames)} frames, device {device}, scale {args.facedetScale}, conf_th {args.conf_th}")
+    print(f"fp32   {ref_time:8.2f} s  {len(frames) / ref_time:7.2f} frames/s  {n_ref} boxes")
+    print(f"{args.quantize:6s} {test_time:8.2f} s  {len(frames) / test_time:7.2f} frames/s  {n_test} boxes")
+    print(f"speedup   {ref_time / test_time:.2f}x")
+    print(f"recall    {len(ious) / n_ref if n_ref else 1.0:.4f}  (fp32 boxes matched at IoU >= {args.iouTh})")
+    print(f"precision {len(ious) / n_test if n_test else 1.0:.4f}  (quantized boxes matched)")
+    print(f"mean IoU  {ious.mean() if len(ious) else float('nan'):.4f}  (over matched boxes)")
+
+
+if __name__ == '__main__':
+    main()
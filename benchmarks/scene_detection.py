@@ -0,0 +1,57 @@
+import argparse
+import time
+
+from scenedetect import VideoStreamCv2
+
+from src.video_frames import make_scene_manager
+from src.scene_detection import detect_scenes_fast
+
+
+def cuts_of(scene_list):
+    """Source frames where a new scene starts."""
+    return [start.frame_num for start, _ in scene_list[1:]]
+
+
+def full_resolution(video_path):
+    scene_manager = make_scene_manager()
+    scene_manager.detect_scenes(video=VideoStreamCv2(video_path))
+    return scene_manager.get_scene_list(start_in_scene=True)
+
+
+def compare(ref_cuts, test_cuts, tolerance):
+    """Matches every test cut to an unused reference cut at most tolerance frames away."""
+    unmatched = list(ref_cuts)
+    extra = []
+    for cut in test_cuts:
+        near = [ref for ref in unmatched if abs(ref - cut) <= tolerance]
+        if near:
+            unmatched.remove(min(near, key=lambda ref: abs(ref - cut)))
+        else:
+            extra.append(cut)
+    return len(ref_cuts) - len(unmatched), unmatched, extra
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare fast scene detection against full-resolution ContentDetector")
+    parser.add_argument('--input_video', type=str, required=True, help='Sample clip')
+    parser.add_argument('--frameSkip', type=int, nargs='+', default=[0, 4, 9], help='Frame skips to test')
+    parser.add_argument('--width', type=int, default=160, help='Width of the downscaled frames')
+    parser.add_argument('--tolerance', type=int, default=0, help='Frames a cut may be off and still match')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    ref_cuts = cuts_of(full_resolution(args.input_video))
+    ref_time = time.perf_counter() - start
+    print(f"full      {ref_time:8.2f} s  {len(ref_cuts)} cuts: {ref_cuts}")
+
+    for frame_skip in args.frameSkip:
+        start = time.perf_counter()
+        test_cuts = cuts_of(detect_scenes_fast(args.input_video, frame_skip, args.width))
+        test_time = time.perf_counter() - start
+        matched, missed, extra = compare(ref_cuts, test_cuts, args.tolerance)
+        print(f"skip {frame_skip:<4d} {test_time:8.2f} s  {ref_time / test_time:5.2f}x  "
+              f"{matched}/{len(ref_cuts)} cuts matched, missed {missed}, extra {extra}")
+
+
+if __name__ == '__main__':
+    main()
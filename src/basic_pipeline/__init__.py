@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the pipeline stages in src/ import each other as top-level modules, the way cli.py runs them from src/;
+# make them importable when the batch pipeline runs from the repository root
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if SRC_DIR not in sys.path:
+    sys.path.append(SRC_DIR)
@@ -6,6 +6,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 import json
 
+from src.detection_store import load_detections
+
 
 def get_frame_width_from_images(args):
     """Extracts frame width from the first available image."""
@@ -21,90 +23,123 @@ def get_frame_width_from_images(args):
     return frame_width
 
 
-def do_side_by_side_inference(args):
-    """Processes bounding boxes and determines their position relative to frame width."""
-    dets = pickle.load(open(os.path.join(args.savePath, 'faces.pckl'), 'rb'))
-    frame_width = get_frame_width_from_images(args)
-
-    results = []
-
-    for detection in dets:
-
-        left = []
-        right = []
+def get_frame_width(args):
+    """Reads the frame width from metadata.json, falling back to the video container's metadata."""
+    metadata_path = os.path.join(args.savePath, "metadata.json")
+    if os.path.isfile(metadata_path):
+        with open(metadata_path) as f:
+            meta = json.load(f)
+        if "frame_width" in meta:
+            return meta["frame_width"]
+
+    cap = cv2.VideoCapture(args.input_video)
+    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    cap.release()
+    if frame_width <= 0:
+        return get_frame_width_from_images(args)
+    return frame_width
 
-        for face in detection:
-            bbox = face["bbox"]
-            x_centroid = (bbox[0] + bbox[2]) / 2  # (x_min + x_max) / 2
-            position = "RIGHT" if x_centroid > (frame_width / 2) else "LEFT"
 
-            item = {
-                "frame": face["frame"],
-                "centroid_x": round(x_centroid, 2),
-                "position": position,
-                "bbox": bbox,
-                "confidence": round(face["conf"], 4)
-            }
+def side_by_side_stats(dets, frame_width, bins=16):
+    """Splits the faces of Detections into LEFT and RIGHT of the frame middle, on the flat detection columns.
+
+    Returns NumPy arrays: per face the sampled frame, the x centroid and whether it's on the right, per
+    frame the LEFT and RIGHT face counts, a histogram of the centroids over bins columns of the frame
+    and, per side, how many frames have each number of faces.
+    """
+    boxes = dets.bboxes()
+    counts = dets.counts()
+    centroid_x = (boxes[:, 0] + boxes[:, 2]) / 2
+    right = centroid_x > frame_width / 2
+
+    # frame of every row, from the per-frame offsets
+    frame_of_row = np.repeat(np.arange(len(dets)), counts)
+    right_count = np.bincount(frame_of_row[right], minlength=len(dets))
+    left_count = counts - right_count
+
+    centroid_hist, bin_edges = np.histogram(centroid_x, bins=bins, range=(0, frame_width))
+    return {
+        "frame_width": frame_width,
+        "frame": np.asarray(dets.columns["frame"]),
+        "centroid_x": centroid_x,
+        "right": right,
+        "bbox": boxes[:, :4],
+        "confidence": boxes[:, 4],
+        "left_count": left_count,
+        "right_count": right_count,
+        "centroid_hist": centroid_hist,
+        "centroid_bin_edges": bin_edges,
+        "left_faces_per_frame": np.unique(left_count, return_counts=True),
+        "right_faces_per_frame": np.unique(right_count, return_counts=True),
+    }
+
+
+def side_by_side_json(stats):
+    """stats as column lists: the face fields once per column instead of a dict per face."""
+    def counts(values_counts):
+        return {"faces": values_counts[0].tolist(), "frames": values_counts[1].tolist()}
+
+    return {
+        "frame_width": stats["frame_width"],
+        "faces": {
+            "frame": stats["frame"].tolist(),
+            "centroid_x": np.round(stats["centroid_x"], 2).tolist(),
+            "position": np.where(stats["right"], "RIGHT", "LEFT").tolist(),
+            "bbox": np.round(stats["bbox"], 2).tolist(),
+            "confidence": np.round(stats["confidence"], 4).tolist(),
+        },
+        "frames": {
+            "left_count": stats["left_count"].tolist(),
+            "right_count": stats["right_count"].tolist(),
+        },
+        "histograms": {
+            "centroid_x": {"bin_edges": stats["centroid_bin_edges"].tolist(), "faces": stats["centroid_hist"].tolist()},
+            "left_faces_per_frame": counts(stats["left_faces_per_frame"]),
+            "right_faces_per_frame": counts(stats["right_faces_per_frame"]),
+        },
+    }
 
 
-            if position == "LEFT":
-                left.append(item)
-            else:
-                right.append(item)
+def do_side_by_side_inference(args):
+    """Processes bounding boxes and determines their position relative to frame width.
 
-        results.append({"left": left, "right": right})
+    Writes side_by_side_stats to face_inference.json as compact JSON columns (see side_by_side_json)
+    and returns the stats.
+    """
+    stats = side_by_side_stats(load_detections(args.savePath), get_frame_width(args))
 
     # Save results
     output_file = os.path.join(args.savePath, "face_inference.json")
     with open(output_file, "w") as f:
-        json.dump(results, f, indent=4)
+        json.dump(side_by_side_json(stats), f, separators=(',', ':'))
 
     print(f"Results saved to {output_file}")
 
-    return results
-
-
-def count_left_right_faces(results):
-    # TODO: Need to improve this
-    left_numbers = []
-    right_numbers = []
-    for i in results:
-        left_numbers.append(len(i["left"]))
+    return stats
 
-        right_numbers.append(len(i["right"]))
 
-    left_arr = np.array(left_numbers)
-    right_arr = np.array(right_numbers)
-
-    print(np.unique(left_arr, return_counts=True))
-    print(np.unique(right_arr, return_counts=True))
+def count_left_right_faces(stats):
+    """Prints how many frames have each number of LEFT and of RIGHT faces."""
+    print(stats["left_faces_per_frame"])
+    print(stats["right_faces_per_frame"])
 
 
 
 def count_faces_per_frame(args):
-    dets = pickle.load(open(os.path.join(args.savePath, 'faces.pckl'), 'rb'))
-
     """Counts the number of detected faces per frame and returns a list."""
-    face_counts = [len(frame_faces) for frame_faces in dets]
-    return face_counts
+    return load_detections(args.savePath).counts().tolist()
 
 
 
-def plot_centroid_positions(results):
+def plot_centroid_positions(stats):
     """Plots centroid values for LEFT and RIGHT positions over time."""
-    frames = [res["frame"] for res in results]
-    centroids = [res["centroid_x"] for res in results]
-    positions = [res["position"] for res in results]
-
-    # Split left/right
-    left_centroids = [c if p == "LEFT" else None for c, p in zip(centroids, positions)]
-    right_centroids = [c if p == "RIGHT" else None for c, p in zip(centroids, positions)]
+    frames, centroids, right = stats["frame"], stats["centroid_x"], stats["right"]
 
     plt.figure(figsize=(10, 5))
-    plt.scatter(frames, left_centroids, color='blue', label="Left", alpha=0.7)
-    plt.scatter(frames, right_centroids, color='red', label="Right", alpha=0.7)
+    plt.scatter(frames[~right], centroids[~right], color='blue', label="Left", alpha=0.7)
+    plt.scatter(frames[right], centroids[right], color='red', label="Right", alpha=0.7)
 
-    plt.axhline(xmin=0, xmax=max(frames), linestyle="--", color="gray", alpha=0.5, label="Midpoint")
+    plt.axhline(stats["frame_width"] / 2, linestyle="--", color="gray", alpha=0.5, label="Midpoint")
 
     plt.xlabel("Frame Number")
     plt.ylabel("Centroid X-Position")
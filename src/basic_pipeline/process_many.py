@@ -1,13 +1,17 @@
 import os
-import json
 import glob
+import time
+import argparse
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import cv2
 from constants import ROOT_DIR
-from src.faceDetector.s3fd import S3FD
-from src.basic_pipeline.pipe import (
-    extract_frames,
-    scene_detect,
-    inference_video, get_video_metadata,
-)
+from src.manifest import Manifest
+from src.video_frames import frame_step_for_rate
+from src.basic_pipeline.pipe import get_video_metadata
+from face_tracking import detect_stages, build_detector
 
 import warnings
 
@@ -17,43 +21,289 @@ warnings.filterwarnings("ignore")
 from src.basic_pipeline.bbox_inference import do_side_by_side_inference
 
 
-def process_videos(input_dir, output_dir):
-    """Processes all video files in input_dir and saves results to output_dir."""
-    os.makedirs(output_dir, exist_ok=True)  # Ensure output directory exists
+def make_args(video_path, output_dir, settings):
+    """Builds the per-video args object the pipeline functions expect."""
+    video_name = os.path.splitext(os.path.basename(video_path))[0]
+    save_path = os.path.join(output_dir, video_name)  # Unique folder for each video
 
-    video_files = glob.glob(os.path.join(input_dir, "*.mp4"))  # Adjust extension if needed
+    os.makedirs(save_path, exist_ok=True)  # Ensure subfolder exists
+
+    args = type('Args', (object,), {})()  # Simple object for args
+    args.input_video = video_path
+    args.savePath = save_path
+    args.facedetScale = 0.25
+    args.pyramidScales = settings['pyramid_scales']
+    args.autoScale = settings['auto_scale']
+    args.autoScaleFrames = 16
+    args.minFaceSize = None
+    args.batchSize = settings['batch_size']
+    args.device = settings['device']
+    args.threads = settings['threads']
+    args.channelsLast = settings['channels_last']
+    args.compileMode = settings['compile_mode']
+    args.extractionFrameRate = 5
+    args.stream = settings['stream']
+    args.saveFrames = settings['save_frames']
+    args.workers = settings['workers']
+    args.queueDepth = settings['queue_depth']
+    args.confTh = 0.9
+    args.checkpointEvery = 250
+    args.cacheDir = settings['cache_dir']
+    args.cacheSize = settings['cache_size']
+    args.keyframeInterval = settings['keyframe_interval']
+    args.minTrackerConf = 0.6
+    args.roiInterval = settings['roi_interval']
+    args.roiPad = 1.0
+    args.fastScenes = settings['fast_scenes']
+    args.sceneFrameSkip = 4
+    return args
 
-    if not video_files:
-        print(f"No video files found in {input_dir}")
-        return
 
-    for video_path in video_files:
-        video_name = os.path.splitext(os.path.basename(video_path))[0]
-        save_path = os.path.join(output_dir, video_name)  # Unique folder for each video
+def make_args_for_detector(settings):
+    """The subset of the per-video args that build_detector needs."""
+    args = type('Args', (object,), {})()
+    args.device = settings['device']
+    args.threads = settings['threads']
+    args.channelsLast = settings['channels_last']
+    args.compileMode = settings['compile_mode']
+    return args
 
-        os.makedirs(save_path, exist_ok=True)  # Ensure subfolder exists
 
-        print(f"Processing {video_path}...")
+def process_video(video_path, output_dir, settings, detector=None):
+    """Runs the whole pipeline on one video and returns its stats (frames detected and seconds taken)."""
+    start = time.time()
+    print(f"Processing {video_path}...")
 
-        args = type('Args', (object,), {})()  # Simple object for args
-        args.input_video = video_path
-        args.savePath = save_path
-        args.facedetScale = 0.25
-        args.extractionFrameRate = 5
+    args = make_args(video_path, output_dir, settings)
 
+    # stages finished by an earlier run on the same video with the same parameters are skipped
+    manifest = Manifest(args.savePath, args.input_video, {
+        "facedetScale": args.facedetScale,
+        "extractionFrameRate": args.extractionFrameRate,
+        "confTh": args.confTh,
+        "keyframeInterval": args.keyframeInterval,
+        "roiInterval": args.roiInterval,
+        "fastScenes": args.fastScenes,
+        "pyramidScales": args.pyramidScales,
+        "autoScale": args.autoScale,
+    })
+
+    if not manifest.is_done('metadata'):
         get_video_metadata(args)
+        manifest.mark_done('metadata', ['metadata.json'])
+
+    # scale calibration, frame extraction, scene and face detection, shared with cli.py
+    frame_step = frame_step_for_rate(args.input_video, args.extractionFrameRate)
+    dets = detect_stages(args, args.input_video, frame_step, manifest, detector)
+
+    # Run inference
+    if not manifest.is_done('side_by_side'):
+        do_side_by_side_inference(args)
+        manifest.mark_done('side_by_side', ['face_inference.json'])
+
+    return {"video": video_path, "status": "ok", "frames": len(dets), "seconds": time.time() - start}
+
+
+def safe_process_video(video_path, output_dir, settings, detector):
+    """process_video that reports a failure in its stats instead of raising, so one bad file doesn't stop a run."""
+    start = time.time()
+    try:
+        return process_video(video_path, output_dir, settings, detector)
+    except Exception:
+        print(f"Failed {video_path}:\n{traceback.format_exc()}")
+        return {"video": video_path, "status": "failed", "frames": 0, "seconds": time.time() - start}
+
+
+# per worker process state, filled once by _init_worker
+_worker = {}
+
+
+def _init_worker(output_dir, settings):
+    warnings.filterwarnings("ignore")
+    cv2.setNumThreads(1)
+    _worker["output_dir"] = output_dir
+    _worker["settings"] = settings
+    _worker["detector"] = build_detector(make_args_for_detector(settings))
+
+
+def _process_in_worker(video_path):
+    return safe_process_video(video_path, _worker["output_dir"], _worker["settings"], _worker["detector"])
+
+
+def _failed(video_path, seconds=0.0):
+    return {"video": video_path, "status": "failed", "frames": 0, "seconds": seconds}
+
+
+def process_in_pool(video_files, output_dir, settings, processes):
+    """
+    Runs the videos over a pool of spawned worker processes, one detector per worker.
+
+    A worker that dies hard (segfault, OOM kill) or fails in _init_worker breaks the whole pool. The videos
+    that were in flight are then retried once in a fresh pool, the rest are resubmitted as normal. A video that
+    was alone in flight when the pool broke, or breaks it twice, is recorded as failed. If a fresh pool breaks
+    before finishing a single video, every remaining video is recorded as failed.
+    """
+    pending = list(reversed(video_files))
+    crashes = {}
+    results = []
+    broken_in_a_row = 0
+    while pending:
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(processes, mp_context=ctx, initializer=_init_worker,
+                                 initargs=(output_dir, settings)) as pool:
+            running = {}
+            broken = False
+            finished = 0
+            while (pending or running) and not broken:
+                while pending and len(running) < processes:
+                    video_path = pending.pop()
+                    running[pool.submit(_process_in_worker, video_path)] = (video_path, time.time())
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    video_path, start = running.pop(future)
+                    try:
+                        results.append(future.result())
+                        finished += 1
+                    except BrokenProcessPool:
+                        running[future] = (video_path, start)
+                        broken = True
+                    except Exception:
+                        print(f"Failed {video_path}:\n{traceback.format_exc()}")
+                        results.append(_failed(video_path, time.time() - start))
+                        finished += 1
+
+            if not broken:
+                break
+            broken_in_a_row = 0 if finished else broken_in_a_row + 1
+            print(f"Worker pool broke with {len(running)} video(s) in flight")
+            for future, (video_path, start) in running.items():
+                if future.done() and future.exception() is None:
+                    results.append(future.result())
+                    continue
+                crashes[video_path] = crashes.get(video_path, 0) + 1
+                if len(running) == 1 or crashes[video_path] > 1:
+                    print(f"Failed {video_path}: worker process died")
+                    results.append(_failed(video_path, time.time() - start))
+                else:
+                    pending.append(video_path)
+            if broken_in_a_row > 1:
+                print(f"Worker pool keeps breaking, giving up on {len(pending)} video(s)")
+                results.extend(_failed(video_path) for video_path in pending)
+                break
+    return sorted(results, key=lambda r: r["video"])
+
+
+def print_summary(results, elapsed):
+    failed = [r for r in results if r["status"] != "ok"]
+    total_frames = sum(r["frames"] for r in results)
+    print(f"Processed {len(results)} videos ({len(failed)} failed) in {elapsed:.1f} s, "
+          f"{total_frames / max(elapsed, 1e-9):.2f} frames/s overall")
+    print(f"  {'video':<40s} {'status':<8s} {'frames':>8s} {'seconds':>9s} {'frames/s':>9s}")
+    for r in results:
+        name = os.path.basename(r["video"])
+        print(f"  {name:<40s} {r['status']:<8s} {r['frames']:8d} {r['seconds']:9.1f} "
+              f"{r['frames'] / max(r['seconds'], 1e-9):9.2f}")
+
+
+def process_videos(input_dir, output_dir, device='auto', threads=None, channels_last=False, compile_mode=None,
+                   stream=True, save_frames=False, workers=2, queue_depth=4, processes=1, cache_dir=None,
+                   cache_size=2, keyframe_interval=0, roi_interval=0, fast_scenes=False,
+                   pyramid_scales=None, auto_scale=False, batch_size=8):
+    """Processes all video files in input_dir and saves results to output_dir.
+
+    device, threads, channels_last and compile_mode are passed on to the S3FD face detector.
+    With stream the frames are decoded straight into the detector instead of going through
+    ffmpeg-extracted JPEGs, save_frames still writes the sampled frames to pyframes/.
+    workers threads decode and preprocess frame batches of batch_size frames ahead of the detector,
+    with at most queue_depth batches in flight.
+
+    With processes > 1 the videos are spread over a process pool. Every worker loads the model once
+    and handles one video at a time, so memory stays bounded by processes videos in flight. Without
+    threads, each worker gets an equal share of the cores for torch.
+    A failing video is reported in the final summary instead of stopping the run.
+
+    With cache_dir, detections are kept in an on-disk cache of at most cache_size GB shared by all
+    runs, so rerunning videos (e.g. to tune the tracking) skips the face detector.
+    With keyframe_interval, the detector runs at most every keyframe_interval sampled frames and
+    boxes are propagated with optical flow in between. With roi_interval, the full frame is detected
+    every roi_interval sampled frames and only crops around the last faces in between.
+    With fast_scenes, scenes are detected on downscaled frames with frames skipped in between.
+    With pyramid_scales, faces are detected at all those scales and merged by box voting.
+    With auto_scale, every video is detected at the smallest scale that keeps recall on a few sampled frames.
+    """
+    os.makedirs(output_dir, exist_ok=True)  # Ensure output directory exists
+
+    video_files = sorted(glob.glob(os.path.join(input_dir, "*.mp4")))  # Adjust extension if needed
+
+    if not video_files:
+        print(f"No video files found in {input_dir}")
+        return
 
-        extract_frames(args.input_video, args.savePath, args.extractionFrameRate)
-        scene_list = scene_detect(args.input_video, args.savePath)
+    settings = {
+        "device": device,
+        "threads": threads,
+        "channels_last": channels_last,
+        "compile_mode": compile_mode,
+        "stream": stream,
+        "save_frames": save_frames,
+        "workers": workers,
+        "queue_depth": queue_depth,
+        "batch_size": batch_size,
+        "cache_dir": cache_dir,
+        "cache_size": cache_size,
+        "keyframe_interval": keyframe_interval,
+        "roi_interval": roi_interval,
+        "fast_scenes": fast_scenes,
+        "pyramid_scales": pyramid_scales,
+        "auto_scale": auto_scale,
+    }
 
-        dets = inference_video(args)
+    start = time.time()
+    processes = min(processes, len(video_files))
+    if processes > 1:
+        if settings["threads"] is None:
+            settings["threads"] = max(1, (os.cpu_count() or 1) // processes)
+        results = process_in_pool(video_files, output_dir, settings, processes)
+    else:
+        detector = build_detector(make_args_for_detector(settings))
+        results = [safe_process_video(video_path, output_dir, settings, detector) for video_path in video_files]
 
-        # Run inference
-        res = do_side_by_side_inference(args)
+    print_summary(results, time.time() - start)
+    return results
 
 
 if __name__ == '__main__':
-    input_directory = os.path.join(ROOT_DIR, "data/videos")
-    output_directory = os.path.join(ROOT_DIR, "data/out")
+    parser = argparse.ArgumentParser(description="Face detection over a folder of videos")
+    parser.add_argument('--input_dir', type=str, default=os.path.join(ROOT_DIR, "data/videos"), help='Folder with .mp4 files')
+    parser.add_argument('--output_dir', type=str, default=os.path.join(ROOT_DIR, "data/out"), help='Output folder')
+    parser.add_argument('--device', type=str, default='auto', choices=['auto', 'cpu', 'cuda'], help='Face detection device')
+    parser.add_argument('--threads', type=int, default=None, help='Torch intra-op threads (default: torch default)')
+    parser.add_argument('--channelsLast', action='store_true', help='Run face detection in channels-last memory format')
+    parser.add_argument('--compileMode', type=str, default=None, choices=['trace', 'compile'],
+                        help='Trace (torch.jit.trace) or compile (torch.compile) the face detector')
+    parser.add_argument('--noStream', dest='stream', action='store_false',
+                        help='Extract JPEG frames with ffmpeg first instead of decoding in memory')
+    parser.add_argument('--saveFrames', action='store_true', help='Also write the sampled frames as JPEGs (debugging)')
+    parser.add_argument('--batchSize', type=int, default=8, help='Frames per face detection forward pass')
+    parser.add_argument('--workers', type=int, default=2, help='Threads decoding and preprocessing frames')
+    parser.add_argument('--queueDepth', type=int, default=4, help='Max preprocessed batches waiting for the detector')
+    parser.add_argument('--processes', type=int, default=1, help='Videos processed in parallel, one model per process')
+    parser.add_argument('--cacheDir', type=str, default=None, help='Folder of the detection cache (default: no cache)')
+    parser.add_argument('--cacheSize', type=float, default=2, help='Max size of the detection cache in GB')
+    parser.add_argument('--keyframeInterval', type=int, default=0,
+                        help='Run the face detector every n sampled frames, optical flow in between (0: every frame)')
+    parser.add_argument('--roiInterval', type=int, default=0,
+                        help='Detect the full frame every n sampled frames, crops around the faces in between (0: off)')
+    parser.add_argument('--fastScenes', action='store_true',
+                        help='Detect scenes on downscaled frames, skipping frames between comparisons')
+    parser.add_argument('--pyramidScales', type=float, nargs='+', default=None,
+                        help='Detect at several scales (e.g. 0.25 0.5 1) merged by box voting')
+    parser.add_argument('--autoScale', action='store_true',
+                        help='Pick the smallest detection scale that keeps recall on frames sampled from each video')
+    cli_args = parser.parse_args()
 
-    process_videos(input_directory, output_directory)
+    process_videos(cli_args.input_dir, cli_args.output_dir, cli_args.device, cli_args.threads,
+                   cli_args.channelsLast, cli_args.compileMode, cli_args.stream, cli_args.saveFrames,
+                   cli_args.workers, cli_args.queueDepth, cli_args.processes, cli_args.cacheDir,
+                   cli_args.cacheSize, cli_args.keyframeInterval, cli_args.roiInterval,
+                   cli_args.fastScenes, cli_args.pyramidScales, cli_args.autoScale, cli_args.batchSize)
@@ -1,53 +1,182 @@
-import sys, time, os, argparse, glob, subprocess, warnings, cv2, pickle, numpy, json
+import sys, os, argparse, warnings
 
-from extract_frames_scenes import extract_frames, scene_detect, rename_frames
-from face_tracking import track_faces, inference_video
-from pckl2json import convert_pickles_to_json
+# Every command imports what it needs when it runs: torch, torchvision, scipy and scenedetect take seconds
+# to import, and converting or tracking doesn't need the detector at all.
+from manifest import Manifest
 
 
 warnings.filterwarnings("ignore")
 
-parser = argparse.ArgumentParser(description="Scene & Face Detection")
-parser.add_argument('--input_video', type=str, required=True, help='Path to the input video file')
-parser.add_argument('--output_folder', type=str, required=True, help='Path to the output folder')
-parser.add_argument('--facedetScale', type=float, default=0.25, help='Scale factor for face detection')
-parser.add_argument('--minTrack', type=int, default=10, help='Min frames for each shot')
-parser.add_argument('--numFailedDet', type=int, default=10, help='Missed detections before tracking stops')
-parser.add_argument('--minFaceSize', type=int, default=1, help='Minimum face size in pixels')
-parser.add_argument('--cropScale', type=float, default=0.40, help='Scale bounding box')
-parser.add_argument('--start', type=int, default=0, help='Start time of the video')
-parser.add_argument('--duration', type=int, default=0, help='Duration of the video')
-parser.add_argument('--frameStep', type=int, default=1, help='Skip frames during extraction')
-args = parser.parse_args()
+COMMANDS = ['run', 'extract', 'scenes', 'detect', 'track', 'convert']
 
-args.videoPath = args.input_video
-args.savePath = args.output_folder
+# options of the commands that process a video, the ones that change the detections key its manifest
+pipeline = argparse.ArgumentParser(add_help=False)
+pipeline.add_argument('--input_video', type=str, required=True, help='Path to the input video file')
+pipeline.add_argument('--output_folder', type=str, required=True, help='Path to the output folder')
+pipeline.add_argument('--facedetScale', type=float, default=0.25, help='Scale factor for face detection')
+pipeline.add_argument('--minTrack', type=float, default=0.4, help='Min seconds of detections for each track (and shot)')
+pipeline.add_argument('--numFailedDet', type=float, default=0.4,
+                      help='Seconds of missed detections before tracking stops')
+pipeline.add_argument('--minFaceSize', type=int, default=1,
+                      help='Minimum face size in pixels, pyramid scales for smaller faces are skipped')
+pipeline.add_argument('--cropScale', type=float, default=0.40, help='Scale bounding box')
+pipeline.add_argument('--start', type=int, default=0, help='Start time of the video')
+pipeline.add_argument('--duration', type=int, default=0, help='Duration of the video')
+pipeline.add_argument('--frameStep', type=int, default=1, help='Skip frames during extraction')
+pipeline.add_argument('--autoScale', action='store_true',
+                      help='Pick the smallest detection scale that keeps recall on frames sampled from the video')
+pipeline.add_argument('--autoScaleFrames', type=int, default=16, help='Frames sampled for the scale calibration')
+pipeline.add_argument('--pyramidScales', type=float, nargs='+', default=None,
+                      help='Detect at several scales (e.g. 0.25 0.5 1) merged by box voting, instead of facedetScale')
+pipeline.add_argument('--batchSize', type=int, default=8, help='Frames per face detection forward pass')
+pipeline.add_argument('--device', type=str, default='auto', choices=['auto', 'cpu', 'cuda'],
+                      help='Face detection device')
+pipeline.add_argument('--threads', type=int, default=None, help='Torch intra-op threads (default: torch default)')
+pipeline.add_argument('--channelsLast', action='store_true', help='Run face detection in channels-last memory format')
+pipeline.add_argument('--compileMode', type=str, default=None, choices=['trace', 'compile'],
+                      help='Trace (torch.jit.trace) or compile (torch.compile) the face detector')
+pipeline.add_argument('--noStream', dest='stream', action='store_false',
+                      help='Extract JPEG frames with ffmpeg first instead of decoding in memory')
+pipeline.add_argument('--saveFrames', action='store_true', help='Also write the sampled frames as JPEGs (debugging)')
+pipeline.add_argument('--workers', type=int, default=2, help='Threads decoding and preprocessing frames')
+pipeline.add_argument('--queueDepth', type=int, default=4, help='Max preprocessed batches waiting for the detector')
+pipeline.add_argument('--confTh', type=float, default=0.9, help='Face detection confidence threshold')
+pipeline.add_argument('--checkpointEvery', type=int, default=250,
+                      help='Checkpoint face detections every n frames so an interrupted run can resume')
+pipeline.add_argument('--cacheDir', type=str, default=None,
+                      help='Folder of an on-disk detection cache shared across runs (default: no cache)')
+pipeline.add_argument('--cacheSize', type=float, default=2, help='Max size of the detection cache in GB')
+pipeline.add_argument('--keyframeInterval', type=int, default=0,
+                      help='Run the face detector every n sampled frames and at scene cuts, propagating boxes with '
+                           'optical flow in between (0: detect on every frame)')
+pipeline.add_argument('--minTrackerConf', type=float, default=0.6,
+                      help='Re-detect when fewer than this fraction of a face\'s flow points are still tracked')
+pipeline.add_argument('--roiInterval', type=int, default=0,
+                      help='Detect on the full frame every n sampled frames and at scene cuts, and only on crops '
+                           'around the last faces in between (0: full frame every time)')
+pipeline.add_argument('--roiPad', type=float, default=1.0, help='Padding of the roi crops, in face sizes per side')
+pipeline.add_argument('--fastScenes', action='store_true',
+                      help='Detect scenes on downscaled frames, skipping frames between comparisons')
+pipeline.add_argument('--sceneFrameSkip', type=int, default=4, help='Frames skipped between fast scene comparisons')
+pipeline.add_argument('--trackProcesses', type=int, default=1, help='Processes tracking scenes in parallel')
+pipeline.add_argument('--trackMatching', type=str, default='greedy', choices=['greedy', 'hungarian'],
+                      help='Match boxes to tracks greedily in track order, or maximizing the total IoU')
 
+output = argparse.ArgumentParser(add_help=False)
+output.add_argument('--jsonFormat', type=str, default='jsonl', choices=['jsonl', 'json'],
+                    help='JSON Lines (one frame/scene/track per line) or a JSON array per output file')
+
+parser = argparse.ArgumentParser(description="Scene & Face Detection. Without a command, runs the whole pipeline.")
+commands = parser.add_subparsers(dest='command', metavar='command')
+commands.add_parser('run', parents=[pipeline, output], help='Run every stage, skipping those already done')
+commands.add_parser('extract', parents=[pipeline], help='Extract every frameStep-th frame as JPEG with ffmpeg')
+commands.add_parser('scenes', parents=[pipeline], help='Detect the scenes of the video')
+commands.add_parser('detect', parents=[pipeline],
+                    help='Detect faces, on frames from extract with --noStream, resuming an interrupted run')
+commands.add_parser('track', parents=[pipeline], help='Track the detected faces through every scene')
+convert_parser = commands.add_parser('convert', parents=[output], help='Convert the outputs of a folder to JSON')
+convert_parser.add_argument('--output_folder', type=str, required=True, help='Path to the output folder')
+
+
+def make_manifest(args):
+    """Manifest of the output folder; stages finished by an earlier run with the same parameters are skipped."""
+    from face_tracking import detection_scales
 
-def main():
     os.makedirs(args.savePath, exist_ok=True)
-    os.makedirs(os.path.join(args.savePath, 'pyframes'), exist_ok=True)
+    return Manifest(args.savePath, args.videoPath, {
+        'facedetScale': args.facedetScale,
+        'frameStep': args.frameStep,
+        'confTh': args.confTh,
+        'keyframeInterval': args.keyframeInterval,
+        'minTrackerConf': args.minTrackerConf,
+        'roiInterval': args.roiInterval,
+        'roiPad': args.roiPad,
+        'fastScenes': args.fastScenes,
+        'sceneFrameSkip': args.sceneFrameSkip,
+        'pyramidScales': detection_scales(args) if args.pyramidScales else None,
+        'autoScale': args.autoScale,
+        'autoScaleFrames': args.autoScaleFrames,
+    })
 
-    pyframes_path = os.path.join(args.savePath, 'pyframes')
 
-    # Extract frames
-    frame_path = extract_frames(args.videoPath, args.savePath, args.frameStep)
-    if args.frameStep > 1:
-        rename_frames(pyframes_path, args.frameStep)
+def track_params(args):
+    return {'minTrack': args.minTrack, 'numFailedDet': args.numFailedDet, 'minFaceSize': args.minFaceSize,
+            'cropScale': args.cropScale, 'trackMatching': args.trackMatching}
 
-    # Scene detection
-    scene_list = scene_detect(args.videoPath, args.savePath)
 
-    # Face tracking
-    faces = inference_video(args)
+def extract(args):
+    from extract_frames_scenes import extract_frames
 
-    tracks = track_faces(args, faces)
+    manifest = make_manifest(args)
+    extract_frames(args.videoPath, args.savePath, args.frameStep)
+    manifest.mark_done('frames', ['pyframes'])
 
-    # Convert pickles to JSON
-    json_path = os.path.join(args.savePath, 'out_json')
+
+def scenes(args):
+    from extract_frames_scenes import scene_detect
+
+    manifest = make_manifest(args)
+    scene_detect(args.videoPath, args.savePath, args.fastScenes, args.sceneFrameSkip)
+    manifest.mark_done('scenes', ['scene.pckl'])
+
+
+def detect(args):
+    from face_tracking import inference_video, calibrate
+
+    manifest = make_manifest(args)
+    detector = calibrate(args, args.videoPath, manifest)
+    inference_video(args, args.videoPath, args.frameStep, detector=detector, manifest=manifest)
+
+
+def track(args):
+    from face_tracking import track_faces
+    from detection_store import load_detections
+
+    manifest = make_manifest(args)
+    track_faces(args, load_detections(args.savePath))
+    manifest.mark_done('tracks', ['tracks.pckl'], track_params(args))
+
+
+def convert(args):
+    from pckl2json import convert_pickles_to_json
+
+    json_path = os.path.join(args.output_folder, 'out_json')
     os.makedirs(json_path, exist_ok=True)
-    convert_pickles_to_json(args.savePath, json_path)
+    convert_pickles_to_json(args.output_folder, json_path, args.jsonFormat)
+
+
+def run(args):
+    from face_tracking import track_faces, detect_stages
+
+    manifest = make_manifest(args)
+
+    # Scale calibration, frame extraction, scene and face detection
+    faces = detect_stages(args, args.videoPath, args.frameStep, manifest)
+
+    # Face tracking
+    if not manifest.is_done('tracks', track_params(args)):
+        tracks = track_faces(args, faces)
+        manifest.mark_done('tracks', ['tracks.pckl'], track_params(args))
+
+    # Convert pickles to JSON
+    convert(args)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # the whole pipeline is the default command, as before there were commands
+    if argv and argv[0] not in COMMANDS and argv[0] not in ('-h', '--help'):
+        argv = ['run'] + argv
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return
+
+    if args.command != 'convert':
+        args.videoPath = args.input_video
+        args.savePath = args.output_folder
+    {'run': run, 'extract': extract, 'scenes': scenes, 'detect': detect, 'track': track,
+     'convert': convert}[args.command](args)
 
 if __name__ == '__main__':
     main()
-
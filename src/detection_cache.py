@@ -0,0 +1,144 @@
+import os
+import time
+import sqlite3
+import hashlib
+from collections import deque
+
+import numpy as np
+
+DEFAULT_MAX_BYTES = 2 << 30
+# per row on top of the boxes and the key strings: the numeric columns, record headers, the last_used index entry
+ROW_OVERHEAD = 64
+
+
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def model_key(detector):
+    """Identifies the boxes a detector produces: its weights plus the quantize mode."""
+    if not hasattr(detector, '_model_key'):
+        detector._model_key = f"{file_hash(detector.weights_path)}:{detector.quantize}"
+    return detector._model_key
+
+
+class DetectionCache(object):
+    """On-disk S3FD detections shared across runs, in a sqlite file.
+
+    Rows are keyed by (video content hash, frame index, detector scale, confidence threshold, model key),
+    so a rerun of the same video with the same detector settings only has to redo the tracking.
+    The file is kept under max_bytes by evicting the least recently used frames and handing the freed
+    pages back to the filesystem (incremental auto-vacuum and a WAL checkpoint).
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, 'detections.sqlite')
+        self.max_bytes = max_bytes
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        if self.db.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            # auto_vacuum only changes on an empty file or through a VACUUM, a one-off for older cache files
+            self.db.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            self.db.execute('VACUUM')
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute("""CREATE TABLE IF NOT EXISTS detections (
+            video TEXT, frame INTEGER, scale REAL, conf_th REAL, model TEXT,
+            boxes BLOB, nbytes INTEGER, last_used REAL,
+            PRIMARY KEY (video, model, scale, conf_th, frame))""")
+        self.db.execute('CREATE INDEX IF NOT EXISTS detections_lru ON detections (last_used)')
+        self.db.commit()
+
+    def get_all(self, video, model, scale, conf_th):
+        """All cached frames of a video as {frame_idx: (n, 5) bboxes}, marking them as recently used."""
+        key = (video, model, scale, conf_th)
+        rows = self.db.execute('SELECT frame, boxes FROM detections WHERE video=? AND model=? AND scale=? AND conf_th=?',
+                               key).fetchall()
+        if rows:
+            self.db.execute('UPDATE detections SET last_used=? WHERE video=? AND model=? AND scale=? AND conf_th=?',
+                            (time.time(),) + key)
+            self.db.commit()
+        return {frame: np.frombuffer(boxes, dtype=np.float64).reshape(-1, 5) for frame, boxes in rows}
+
+    def put_many(self, video, model, scale, conf_th, items):
+        """Stores (frame_idx, bboxes) items and evicts old frames if the cache grew over max_bytes."""
+        now = time.time()
+        rows = []
+        for frame, bboxes in items:
+            boxes = np.ascontiguousarray(bboxes, dtype=np.float64).tobytes()
+            # the key strings are stored in the row and again in the primary key index
+            nbytes = len(boxes) + 2 * (len(video) + len(model)) + ROW_OVERHEAD
+            rows.append((video, int(frame), scale, conf_th, model, boxes, nbytes, now))
+        if not rows:
+            return
+        self.db.executemany('INSERT OR REPLACE INTO detections VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self.db.commit()
+        self.evict()
+
+    def size(self):
+        """Bytes of the pages in use, tables and indexes included."""
+        page_size = self.db.execute('PRAGMA page_size').fetchone()[0]
+        pages = self.db.execute('PRAGMA page_count').fetchone()[0] - self.db.execute('PRAGMA freelist_count').fetchone()[0]
+        return pages * page_size
+
+    def evict(self, low_water=0.9):
+        """Once the cache is over max_bytes, deletes the least recently used frames down to low_water of it."""
+        size = self.size()
+        if size <= self.max_bytes:
+            return
+        excess = size - low_water * self.max_bytes
+        stale = []
+        for rowid, nbytes in self.db.execute('SELECT rowid, nbytes FROM detections ORDER BY last_used, rowid'):
+            if excess <= 0:
+                break
+            stale.append((rowid,))
+            excess -= nbytes
+        self.db.executemany('DELETE FROM detections WHERE rowid=?', stale)
+        self.db.commit()
+        self.db.execute('PRAGMA incremental_vacuum')
+        self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        self.db.close()
+
+
+def cached_frames(cached, start, frame_count, frame_step=1):
+    """Frame indices to serve straight from cached when it holds every frame_step-th frame from start on.
+
+    frame_count is the (metadata) frame count of the video. Returns the sorted sampled indices, including
+    cached ones past frame_count in case the metadata undercounts, or None if any sampled frame is missing
+    and the video has to be decoded.
+    """
+    if frame_count <= 0 or any(frame_idx not in cached for frame_idx in range(start, frame_count, frame_step)):
+        return None
+    return sorted(frame_idx for frame_idx in cached if frame_idx >= start and (frame_idx - start) % frame_step == 0)
+
+
+def detect_cached(detect, frames, cached):
+    """Serves frames found in cached ({frame_idx: bboxes}) and runs detect on the rest.
+
+    detect is called with an iterable of the missing (frame_idx, frame) items and must yield
+    (frame_idx, bboxes) in the same order, like detect_pipelined. Yields (frame_idx, bboxes, hit)
+    in the order of frames.
+    """
+    order = deque()
+
+    def misses():
+        for frame_idx, frame in frames:
+            order.append(frame_idx)
+            if frame_idx not in cached:
+                yield frame_idx, frame
+
+    for frame_idx, bboxes in detect(misses()):
+        # every frame read before this one is already in order
+        while order[0] != frame_idx:
+            hit = order.popleft()
+            yield hit, cached[hit], True
+        order.popleft()
+        yield frame_idx, bboxes, False
+    while order:
+        hit = order.popleft()
+        yield hit, cached[hit], True
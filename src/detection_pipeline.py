@@ -0,0 +1,158 @@
+import time
+import queue
+import threading
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import torch
+
+
+class StageTimer(object):
+    """Thread-safe wall-clock totals per pipeline stage."""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.seconds[stage] += seconds
+            self.calls[stage] += 1
+
+    def report(self, n_frames, elapsed):
+        print(f"Detected {n_frames} frames in {elapsed:.2f} s ({n_frames / max(elapsed, 1e-9):.2f} frames/s)")
+        for stage in self.seconds:
+            print(f"  {stage:<12s} {self.seconds[stage]:8.2f} s  {self.calls[stage]:6d} calls  "
+                  f"{1000 * self.seconds[stage] / self.calls[stage]:8.2f} ms/call")
+
+
+class BufferPool(object):
+    """Preprocessed batch buffers that are reused from one batch to the next, pinned when the network runs on cuda.
+
+    acquire() hands out a free buffer of the shape or allocates a new one, so there are only as many
+    buffers as batches in flight. release() takes back the buffers behind network inputs once the
+    network is done with them. Only the max_shapes most recently used shapes keep buffers, the others
+    are dropped.
+    """
+
+    def __init__(self, pin_memory=False, max_shapes=1):
+        self.pin_memory = pin_memory
+        self.max_shapes = max_shapes
+        self.free = OrderedDict()
+        self.in_use = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, shape):
+        with self.lock:
+            if shape in self.free:
+                self.free.move_to_end(shape)
+                if self.free[shape]:
+                    return self.free[shape].pop()
+            else:
+                self.free[shape] = []
+                while len(self.free) > self.max_shapes:
+                    self.free.popitem(last=False)
+        return torch.empty(shape, dtype=torch.float32, pin_memory=self.pin_memory)
+
+    def track(self, x, buffer):
+        """Records that the network input x was filled from buffer."""
+        with self.lock:
+            self.in_use[id(x)] = (x, buffer)
+
+    def release(self, xs):
+        with self.lock:
+            for x in xs:
+                entry = self.in_use.pop(id(x), None)
+                if entry is not None and tuple(entry[1].shape) in self.free:
+                    self.free[tuple(entry[1].shape)].append(entry[1])
+
+
+def _prepare_batch(detector, batch, scales, buffers, timer):
+    """Worker side: decodes (for frame paths) and preprocesses one batch of BGR frames into ready tensors."""
+    frames = [frame for _, frame in batch]
+    if isinstance(frames[0], str):
+        start = time.perf_counter()
+        frames = [cv2.imread(fname) for fname in frames]
+        timer.add('decode', time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with torch.inference_mode():
+        xs = [detector.preprocess_bgr(frames, s, buffers) for s in scales]
+    timer.add('preprocess', time.perf_counter() - start)
+
+    frame_size = (frames[0].shape[1], frames[0].shape[0])
+    return [frame_idx for frame_idx, _ in batch], xs, frame_size
+
+
+def detect_pipelined(detector, frames, batch_size=8, conf_th=0.9, scales=[1], nms_th=0.1,
+                     workers=2, queue_depth=4, timer=None):
+    """Runs S3FD over frames with decoding/preprocessing overlapped with inference.
+
+    frames yields (frame_idx, frame) where frame is a BGR image or the path of one. A reader thread
+    groups them into batches and hands them to a pool of workers that decode and preprocess them
+    into tensors; at most queue_depth batches are in flight. The network runs on the calling thread.
+
+    Yields (frame_idx, bboxes) in input order.
+    """
+    timer = timer if timer is not None else StageTimer()
+    # the batch shape is fixed, one per scale, so the buffers of a run are reused throughout it
+    buffers = BufferPool(pin_memory=detector.device == 'cuda', max_shapes=len(scales))
+    ready = queue.Queue(queue_depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read_batches(pool):
+        try:
+            batch = []
+            start = time.perf_counter()
+            for item in frames:
+                if stop.is_set():
+                    return
+                batch.append(item)
+                if len(batch) == batch_size:
+                    timer.add('read', time.perf_counter() - start)
+                    put(pool.submit(_prepare_batch, detector, batch, scales, buffers, timer))
+                    batch = []
+                    start = time.perf_counter()
+            if batch:
+                timer.add('read', time.perf_counter() - start)
+                put(pool.submit(_prepare_batch, detector, batch, scales, buffers, timer))
+        except BaseException as e:
+            put(e)
+        finally:
+            put(None)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        reader = threading.Thread(target=read_batches, args=(pool,), daemon=True)
+        reader.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = ready.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                frame_ids, xs, frame_size = item.result()
+                timer.add('wait', time.perf_counter() - start)
+
+                start = time.perf_counter()
+                batch_bboxes = detector.detect_preprocessed(xs, frame_size, conf_th=conf_th, nms_th=nms_th)
+                # the outputs are on the host, so the network has read the inputs
+                buffers.release(xs)
+                timer.add('inference', time.perf_counter() - start)
+
+                for frame_idx, bboxes in zip(frame_ids, batch_bboxes):
+                    yield frame_idx, bboxes
+        finally:
+            stop.set()
+            reader.join()
@@ -0,0 +1,128 @@
+import os
+import json
+import pickle
+import shutil
+
+import numpy as np
+
+STORE_NAME = 'faces'
+COLUMNS = ['frame', 'x1', 'y1', 'x2', 'y2', 'conf', 'source_frame', 'time']
+BOX_COLUMNS = ['x1', 'y1', 'x2', 'y2', 'conf']
+
+
+class Detections(object):
+    """Face detections of a video as flat columns plus a per-frame offset index.
+
+    The boxes of frame i are rows offsets[i]:offsets[i + 1] of every column. Saved as one .npy per
+    column in a folder, so load() can memory-map them and a scene's frame range is read without
+    deserializing the whole video.
+
+    'frame' is the index among the sampled frames, 'source_frame' the index in the video and 'time'
+    its timestamp in seconds. meta holds the frame_step the video was sampled with and its fps.
+    """
+
+    def __init__(self, columns, offsets, meta=None):
+        self.columns = columns
+        self.offsets = offsets
+        self.meta = meta if meta is not None else {'frame_step': 1, 'fps': None}
+
+    @classmethod
+    def from_frames(cls, frames, frame_step=1, fps=None):
+        """Builds the store from per-frame lists of {'frame', 'bbox', 'conf'} dicts.
+
+        Dicts written before source_frame/time existed get them from frame_step and fps.
+        """
+        counts = np.array([len(faces) for faces in frames], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        rows = np.array([[face['frame'], face.get('source_frame', face['frame'] * frame_step)] + list(face['bbox'])
+                         + [face['conf'], face.get('time', np.nan)] for faces in frames for face in faces],
+                        dtype=np.float64).reshape(-1, 8)
+        columns = {name: rows[:, k] for k, name in enumerate(['frame', 'source_frame'] + BOX_COLUMNS + ['time'])}
+        columns['frame'] = columns['frame'].astype(np.int64)
+        columns['source_frame'] = columns['source_frame'].astype(np.int64)
+        if fps:
+            missing = np.isnan(columns['time'])
+            columns['time'][missing] = columns['source_frame'][missing] / fps
+        return cls(columns, offsets, {'frame_step': frame_step, 'fps': fps})
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for name in COLUMNS:
+            np.save(os.path.join(tmp_path, name + '.npy'), np.ascontiguousarray(self.columns[name]))
+        np.save(os.path.join(tmp_path, 'offsets.npy'), self.offsets)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        mode = 'r' if mmap else None
+        columns = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mode) for name in COLUMNS}
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        return cls(columns, np.load(os.path.join(path, 'offsets.npy')), meta)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        """A frame index gives that frame's (n, 5) boxes, a slice gives a Detections view of the frame range."""
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("Detections only supports contiguous frame ranges")
+            stop = max(start, stop)
+            lo, hi = self.offsets[start], self.offsets[stop]
+            return Detections({name: col[lo:hi] for name, col in self.columns.items()},
+                              self.offsets[start:stop + 1] - lo, self.meta)
+        index = range(len(self))[index]
+        lo, hi = self.offsets[index], self.offsets[index + 1]
+        return np.stack([self.columns[name][lo:hi] for name in BOX_COLUMNS], axis=1)
+
+    def counts(self):
+        """Number of faces per frame."""
+        return np.diff(self.offsets)
+
+    def bboxes(self):
+        """(n, 5) x1, y1, x2, y2, conf rows of all detections."""
+        return np.stack([self.columns[name] for name in BOX_COLUMNS], axis=1)
+
+    def to_frames(self):
+        """Back to per-frame lists of {'frame', 'source_frame', 'time', 'bbox', 'conf'} dicts."""
+        frame = self.columns['frame'].tolist()
+        source_frame = self.columns['source_frame'].tolist()
+        timestamp = self.columns['time'].tolist()
+        bboxes = self.bboxes().tolist()
+        return [[{'frame': frame[k], 'source_frame': source_frame[k], 'time': timestamp[k],
+                  'bbox': bboxes[k][:4], 'conf': bboxes[k][4]} for k in range(lo, hi)]
+                for lo, hi in zip(self.offsets[:-1].tolist(), self.offsets[1:].tolist())]
+
+    def scene_range(self, start_frame, end_frame):
+        """Maps a scene's [start_frame, end_frame) source frames to the sampled frame range covering it."""
+        frame_step = self.meta['frame_step']
+        return -(-start_frame // frame_step), -(-end_frame // frame_step)
+
+
+def save_detections(dets, save_path, frame_step=1, fps=None):
+    """Writes detections (a Detections or per-frame lists of dicts) to save_path/faces/."""
+    if not isinstance(dets, Detections):
+        dets = Detections.from_frames(dets, frame_step, fps)
+    dets.save(os.path.join(save_path, STORE_NAME))
+    return dets
+
+
+def load_detections(save_path, mmap=True):
+    """Reads save_path/faces/, or a faces.pckl written before the columnar store existed.
+
+    A faces.pckl has no time base, its frames are taken as every frame of the video.
+    """
+    path = os.path.join(save_path, STORE_NAME)
+    if os.path.isdir(path):
+        return Detections.load(path, mmap)
+    with open(path + '.pckl', 'rb') as f:
+        return Detections.from_frames(pickle.load(f))
@@ -1,30 +1,39 @@
 import os, subprocess, glob
 
-from scenedetect import VideoStreamCv2, SceneManager, StatsManager
-from scenedetect.detectors import ContentDetector
+from scenedetect import VideoStreamCv2
 
 from utils import save_data
+from video_frames import make_scene_manager
+from scene_detection import detect_scenes_fast
 
 
-def extract_frames(video_path, save_path):
+def extract_frames(video_path, save_path, frame_step=1):
     pyframes_path = os.path.join(save_path, 'pyframes')
     os.makedirs(pyframes_path, exist_ok=True)  # Ensures directory exists
 
     frame_path = os.path.join(pyframes_path, '%06d.jpg')
 
-    subprocess.call(f"ffmpeg -y -i {video_path} -qscale:v 2 -r 5 {frame_path}", shell=True)
+    # keeps every frame_step-th frame, numbered consecutively like video_frames.iter_video_frames(save_dir=...)
+    select = f"-vf \"select=not(mod(n\\,{frame_step}))\" -vsync vfr" if frame_step > 1 else ""
+    subprocess.call(f"ffmpeg -y -i {video_path} -qscale:v 2 {select} {frame_path}", shell=True)
 
     return frame_path
 
 
-def scene_detect(video_path, save_path):
-    video = VideoStreamCv2(video_path)  # No need to open()
-    stats_manager = StatsManager()
-    scene_manager = SceneManager(stats_manager)
-    scene_manager.add_detector(ContentDetector())
+def scene_detect(video_path, save_path, fast=False, frame_skip=4):
+    """Detects the scenes of the video and saves them to save_path/scene.pckl.
 
-    scene_manager.detect_scenes(frame_source=video)  # Directly use video
-    scene_list = scene_manager.get_scene_list(start_in_scene=True)
+    With fast, scenes are detected on downscaled frames, looking at every (frame_skip + 1)-th frame
+    and decoding the skipped ones again only around candidate cuts (see scene_detection).
+    """
+    if fast:
+        scene_list = detect_scenes_fast(video_path, frame_skip)
+    else:
+        video = VideoStreamCv2(video_path)  # No need to open()
+        scene_manager = make_scene_manager()
+
+        scene_manager.detect_scenes(video=video)
+        scene_list = scene_manager.get_scene_list(start_in_scene=True)
 
     save_data(scene_list, os.path.join(save_path, 'scene'))
 
@@ -1 +1,6 @@
-from .s3fd import S3FD
\ No newline at end of file
+def __getattr__(name):
+    # S3FD pulls in torch, it is only imported once asked for, so faceDetector.boxes stays light
+    if name == 'S3FD':
+        from .s3fd import S3FD
+        return S3FD
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
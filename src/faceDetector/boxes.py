@@ -0,0 +1,73 @@
+import numpy as np
+
+# numpy only, so tracking and other box arithmetic can use these without importing torch
+
+
+def nms_(dets, thresh):
+    """
+    Courtesy of Ross Girshick
+    [https://github.com/rbgirshick/py-faster-rcnn/blob/master/lib/nms/py_cpu_nms.py]
+    """
+    x1 = dets[:, 0]
+    y1 = dets[:, 1]
+    x2 = dets[:, 2]
+    y2 = dets[:, 3]
+    scores = dets[:, 4]
+
+    areas = (x2 - x1) * (y2 - y1)
+    order = scores.argsort()[::-1]
+
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(int(i))
+        xx1 = np.maximum(x1[i], x1[order[1:]])
+        yy1 = np.maximum(y1[i], y1[order[1:]])
+        xx2 = np.minimum(x2[i], x2[order[1:]])
+        yy2 = np.minimum(y2[i], y2[order[1:]])
+
+        w = np.maximum(0.0, xx2 - xx1)
+        h = np.maximum(0.0, yy2 - yy1)
+        inter = w * h
+        ovr = inter / (areas[i] + areas[order[1:]] - inter)
+
+        inds = np.where(ovr <= thresh)[0]
+        order = order[inds + 1]
+
+    return np.array(keep).astype(int)
+
+
+def iou_matrix(boxes_a, boxes_b):
+    """Pairwise IoU between (n, 4+) and (m, 4+) arrays of [x1, y1, x2, y2, ...] boxes, shape (n, m).
+
+    Two zero-area boxes have an IoU of 0 rather than NaN.
+    """
+    boxes_a = np.asarray(boxes_a, dtype='float64')[..., :4].reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype='float64')[..., :4].reshape(-1, 4)
+    xx1 = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    yy1 = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    xx2 = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    yy2 = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+
+    inter = np.maximum(0.0, xx2 - xx1) * np.maximum(0.0, yy2 - yy1)
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+
+def box_vote(dets, thresh, vote_th=0.5):
+    """Score-weighted box voting over (n, 5) [x1, y1, x2, y2, score] rows.
+
+    The boxes kept are the ones nms_ keeps at thresh, with the same scores, but each kept box is replaced by the
+    score-weighted mean of the boxes overlapping it by at least vote_th. vote_th is well above the usual NMS
+    threshold so a box never averages in a neighbouring face it merely touches.
+    """
+    if len(dets) == 0:
+        return dets
+    keep = nms_(dets, thresh)
+    voters = iou_matrix(dets[keep], dets) >= vote_th
+    voters[np.arange(len(keep)), keep] = True
+    weights = voters * dets[:, 4]
+    boxes = weights @ dets[:, :4] / weights.sum(axis=1, keepdims=True)
+    return np.hstack((boxes, dets[keep, 4:]))
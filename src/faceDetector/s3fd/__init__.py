@@ -2,68 +2,287 @@ import time, os, sys, subprocess
 import numpy as np
 import cv2
 import torch
-from torchvision import transforms
 from .nets import S3FDNet
-from .box_utils import nms_
+from .box_utils import MIN_SIZES
+from ..boxes import nms_, box_vote, iou_matrix
+from .quantization import quantize_net, convert_int8
 import os
 
 from constants import ROOT_DIR
 
 PATH_WEIGHT = os.path.join(ROOT_DIR, 'src/faceDetector/s3fd/sfd_face.pth')
-if os.path.isfile(PATH_WEIGHT) == False:
-    Link = "1KafnHz7ccT-3IyddBsL5yi2xGtxAKypt"
-    cmd = "gdown --id %s -O %s"%(Link, PATH_WEIGHT)
-    subprocess.call(cmd, shell=True, stdout=None)
+WEIGHTS_ID = "1KafnHz7ccT-3IyddBsL5yi2xGtxAKypt"
 img_mean = np.array([104., 117., 123.])[:, np.newaxis, np.newaxis].astype('float32')
+# the network takes RGB input with the BGR means subtracted
+rgb_mean = img_mean.ravel()[::-1].copy()
+
+DEVICES = ['auto', 'cpu', 'cuda']
+COMPILE_MODES = [None, 'trace', 'compile']
+# smallest PriorBox anchor, in network input pixels
+SMALLEST_ANCHOR = MIN_SIZES[0]
+# candidate scales of calibrate_scale
+AUTO_SCALES = [0.125, 0.25, 0.5, 1]
+# a scale runs in the forward pass of a larger one, zero padded, if its input has at least this fraction of the area
+PAD_RATIO = 0.7
+
+
+def weights_path():
+    """Path of the S3FD weights, downloaded with gdown the first time a detector is built."""
+    if os.path.isfile(PATH_WEIGHT) == False:
+        cmd = "gdown --id %s -O %s"%(WEIGHTS_ID, PATH_WEIGHT)
+        subprocess.call(cmd, shell=True, stdout=None)
+    return PATH_WEIGHT
+
+
+def resolve_device(device='auto'):
+    """Maps 'auto' to 'cuda' when a GPU is available and 'cpu' otherwise."""
+    if device not in DEVICES:
+        raise ValueError(f"Unknown device {device!r}, expected one of {DEVICES}")
+    if device == 'auto':
+        return 'cuda' if torch.cuda.is_available() else 'cpu'
+    return device
+
+
+def pyramid_scales(scales, min_face_size=None):
+    """The scales of a pyramid that are needed to find faces of at least min_face_size frame pixels.
+
+    Scale s finds faces down to about SMALLEST_ANCHOR / s pixels. Scales larger than the smallest one
+    reaching min_face_size only add smaller faces and are dropped. Returned in increasing order.
+    """
+    scales = sorted(scales)
+    if not min_face_size:
+        return scales
+    reaching = [s for s in scales if SMALLEST_ANCHOR / s <= min_face_size]
+    return [s for s in scales if s <= reaching[0]] if reaching else scales
+
+
+def pack_inputs(xs, pad_ratio=PAD_RATIO):
+    """Groups preprocessed batches of the same frames at different scales into as few forward passes as possible.
+
+    A batch joins the pass of a larger one, zero padded (the mean color) at the bottom and right, if it
+    has at least pad_ratio of its area. Yields (x, sizes) with the unpadded (height, width) of each batch
+    stacked in x, in order.
+    """
+    groups = []
+    for i in sorted(range(len(xs)), key=lambda i: -xs[i].size(2) * xs[i].size(3)):
+        h, w = xs[i].shape[2:]
+        for group in groups:
+            gh, gw = xs[group[0]].shape[2:]
+            if h <= gh and w <= gw and h * w >= pad_ratio * gh * gw:
+                group.append(i)
+                break
+        else:
+            groups.append([i])
+
+    for group in groups:
+        gh, gw = xs[group[0]].shape[2:]
+        padded = [torch.nn.functional.pad(xs[i], (0, gw - xs[i].size(3), 0, gh - xs[i].size(2))) for i in group]
+        yield (torch.cat(padded) if len(padded) > 1 else padded[0]), [tuple(xs[i].shape[2:]) for i in group]
+
+
+def calibrate_scale(detector, images, scales=AUTO_SCALES, conf_th=0.9, nms_th=0.1, min_recall=0.95, iou_th=0.5,
+                    batch_size=8):
+    """Picks the smallest of scales that still finds min_recall of the faces found at the largest one.
+
+    images are RGB frames sampled from a video. A scale s can't find faces much smaller than the smallest
+    PriorBox anchor, SMALLEST_ANCHOR / s frame pixels, so scales at which more than 1 - min_recall of the
+    reference faces are that small are not run. The others are run from the smallest up, and the first
+    one matching min_recall of the reference boxes at iou_th is picked.
+
+    Returns (scale, recalls) with the measured recall of every scale that was run. scale is None if no
+    face was found at the largest scale.
+    """
+    def detect(s):
+        return [bboxes for i in range(0, len(images), batch_size)
+                for bboxes in detector.detect_faces_batch(images[i:i + batch_size], conf_th=conf_th, scales=[s],
+                                                          nms_th=nms_th)]
+
+    scales = sorted(scales)
+    reference = detect(scales[-1])
+    if not any(len(bboxes) for bboxes in reference):
+        return None, {}
+    boxes = np.concatenate(reference)
+    sizes = np.sqrt((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]))
+
+    recalls = {scales[-1]: 1.0}
+    for s in scales[:-1]:
+        if np.mean(sizes * s >= SMALLEST_ANCHOR) < min_recall:
+            continue
+        found = sum(int((iou_matrix(ref, test).max(axis=1) >= iou_th).sum())
+                    for ref, test in zip(reference, detect(s)) if len(ref) and len(test))
+        recalls[s] = found / len(boxes)
+        if recalls[s] >= min_recall:
+            return s, recalls
+    return scales[-1], recalls
 
 
 class S3FD():
 
-    def __init__(self, device='cuda'):
+    def __init__(self, device='auto', num_threads=None, channels_last=False, compile_mode=None,
+                 quantize=None, calibration_images=None, calibration_scale=1):
+        """
+        Args:
+            device: 'auto', 'cpu' or 'cuda'.
+            num_threads: torch intra-op threads, None keeps the torch default.
+            channels_last: run the network in NHWC memory format (faster convolutions on most CPUs).
+            compile_mode: None, 'trace' (torch.jit.trace) or 'compile' (torch.compile) for the network heads.
+            quantize: None, 'int8' (static quantization of all convs, CPU only) or 'fp16'.
+            calibration_images: images used to calibrate the int8 model, required with quantize='int8'.
+                They should look like the videos to be processed (a few frames sampled from them).
+            calibration_scale: scale the calibration images are resized with.
+        """
+        if compile_mode not in COMPILE_MODES:
+            raise ValueError(f"Unknown compile mode {compile_mode!r}, expected one of {COMPILE_MODES}")
 
         tstamp = time.time()
-        self.device = device
+        self.device = resolve_device(device)
+        self.channels_last = channels_last
+        self.compile_mode = compile_mode
+        self.quantize = quantize
+        if quantize == 'int8' and self.device != 'cpu':
+            raise ValueError("int8 quantization only runs on the cpu device")
+        if quantize == 'int8' and calibration_images is None:
+            raise ValueError("int8 quantization needs calibration_images to calibrate the activation ranges")
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
 
         # print('[S3FD] loading with', self.device)
         self.net = S3FDNet(device=self.device).to(self.device)
-        PATH = os.path.join(os.getcwd(), PATH_WEIGHT)
+        PATH = os.path.join(os.getcwd(), weights_path())
+        self.weights_path = PATH
         state_dict = torch.load(PATH, map_location=self.device)
         self.net.load_state_dict(state_dict)
         self.net.eval()
+        if self.channels_last:
+            self.net = self.net.to(memory_format=torch.channels_last)
+        self.net = quantize_net(self.net, quantize)
+
+        # built lazily, tracing needs an input of the real batch shape
+        self.heads = None
+        if quantize == 'int8':
+            self.calibrate(calibration_images, scale=calibration_scale)
         # print('[S3FD] finished loading (%.4f sec)' % (time.time() - tstamp))
-    
-    def detect_faces(self, image, conf_th=0.8, scales=[1]):
 
-        w, h = image.shape[1], image.shape[0]
+    @staticmethod
+    def _fill(images, s, channels, allocate):
+        """Resizes images by s and writes them mean-subtracted into an NCHW float buffer from allocate(shape).
+
+        channels are the image channels holding R, G and B. Each channel goes from the resized HWC
+        image into the buffer in one pass, doing the reorder, the float conversion and the mean
+        subtraction on the way.
+        """
+        scaled_img = cv2.resize(images[0], dsize=(0, 0), fx=s, fy=s, interpolation=cv2.INTER_LINEAR)
+        buffer = allocate((len(images), 3) + scaled_img.shape[:2])
+        batch = buffer.numpy()
+        for i, image in enumerate(images):
+            if i:
+                scaled_img = cv2.resize(image, dsize=(0, 0), fx=s, fy=s, interpolation=cv2.INTER_LINEAR)
+            for c, channel in enumerate(channels):
+                np.subtract(scaled_img[:, :, channel], rgb_mean[c], out=batch[i, c], dtype=np.float32)
+        return buffer
+
+    def preprocess(self, images, s):
+        """Resizes RGB images by s and returns them as a mean-subtracted NCHW float tensor on the device."""
+        return self._fill(images, s, (0, 1, 2), lambda shape: torch.empty(shape, dtype=torch.float32)).to(self.device)
+
+    def preprocess_bgr(self, frames, s, pool=None):
+        """preprocess for BGR frames as they come from the decoder, without converting them to RGB first.
 
-        bboxes = np.empty(shape=(0, 5))
+        With a pool (detection_pipeline.BufferPool) the batch is written into one of its buffers and on
+        cuda copied to the device without blocking; the caller releases it once the batch has run.
+        """
+        if pool is None:
+            allocate = lambda shape: torch.empty(shape, dtype=torch.float32)
+            return self._fill(frames, s, (2, 1, 0), allocate).to(self.device)
+        buffer = self._fill(frames, s, (2, 1, 0), pool.acquire)
+        x = buffer if self.device == 'cpu' else buffer.to(self.device, non_blocking=True)
+        pool.track(x, buffer)
+        return x
 
+    def calibrate(self, images, scale=1, batch_size=8):
+        """Feeds images through the observed int8 model and converts it to int8."""
         with torch.no_grad():
-            for s in scales:
-                scaled_img = cv2.resize(image, dsize=(0, 0), fx=s, fy=s, interpolation=cv2.INTER_LINEAR)
+            for i in range(0, len(images), batch_size):
+                x = self.preprocess(images[i:i + batch_size], scale)
+                if self.channels_last:
+                    x = x.contiguous(memory_format=torch.channels_last)
+                self.net.heads(x)
+        convert_int8(self.net)
+
+    def forward(self, x):
+        """Runs the network on a preprocessed NCHW batch and returns the Detect output."""
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        if self.quantize == 'fp16':
+            x = x.half()
+
+        if self.compile_mode is None:
+            return self.net(x)
+
+        if self.heads is None:
+            if self.compile_mode == 'trace':
+                self.heads = torch.jit.trace_module(self.net, {'heads': x}).heads
+            else:
+                self.heads = torch.compile(self.net.heads)
+        loc, conf = self.heads(x)
+        return self.net.detect_from_heads(x.size()[2:], loc, conf)
+
+    def detect_faces(self, image, conf_th=0.8, scales=[1], nms_th=0.1, bgr=False):
+
+        return self.detect_faces_batch([image], conf_th=conf_th, scales=scales, nms_th=nms_th, bgr=bgr)[0]
+
+    def detect_faces_batch(self, images, conf_th=0.8, scales=[1], nms_th=0.1, bgr=False):
+        """Detects faces in a list of same-sized images, all frames of a scale in one forward pass.
+
+        With several scales, scales of similar size share a forward pass (see pack_inputs) and the
+        boxes of all scales are merged by box voting instead of NMS.
+
+        images are RGB, or BGR frames straight from the decoder with bgr.
+
+        Returns a list with one (n, 5) array of [x1, y1, x2, y2, score] per image.
+        """
+
+        w, h = images[0].shape[1], images[0].shape[0]
+
+        with torch.inference_mode():
+            xs = [self.preprocess_bgr(images, s) if bgr else self.preprocess(images, s) for s in scales]
+
+        return self.detect_preprocessed(xs, (w, h), conf_th=conf_th, nms_th=nms_th)
+
+    def detect_preprocessed(self, xs, frame_size, conf_th=0.8, nms_th=0.1):
+        """Detects faces in already preprocessed batches, one (N, 3, H, W) tensor per scale of the same N frames.
+
+        frame_size is the (width, height) of the original frames, the boxes are returned in that space.
+        A single scale is merged with NMS at nms_th, several scales with box voting: NMS at nms_th decides
+        which boxes survive and each survivor is averaged with the boxes overlapping it strongly.
+        """
+
+        w, h = frame_size
+        n = xs[0].size(0)
+
+        bboxes = [[np.empty(shape=(0, 5))] for _ in range(n)]
+
+        with torch.inference_mode():
+            for x, sizes in pack_inputs(xs) if len(xs) > 1 else [(xs[0], [tuple(xs[0].shape[2:])])]:
+                y = self.forward(x)
+
+                # one transfer for the whole batch, rows of each class are sorted by decreasing score
+                detections = y.data.cpu().numpy()
+
+                for k, (in_h, in_w) in enumerate(sizes):
+                    # boxes are relative to the padded input, the frame fills in_w x in_h of it
+                    scale = np.array([w * x.size(3) / in_w, h * x.size(2) / in_h] * 2, dtype='float32')
+                    for b in range(n):
+                        dets = detections[k * n + b].reshape(-1, 5)
+                        dets = dets[dets[:, 0] > conf_th]
+                        bboxes[b].append(np.hstack((dets[:, 1:] * scale, dets[:, :1])))
 
-                scaled_img = np.swapaxes(scaled_img, 1, 2)
-                scaled_img = np.swapaxes(scaled_img, 1, 0)
-                scaled_img = scaled_img[[2, 1, 0], :, :]
-                scaled_img = scaled_img.astype('float32')
-                scaled_img -= img_mean
-                scaled_img = scaled_img[[2, 1, 0], :, :]
-                x = torch.from_numpy(scaled_img).unsqueeze(0).to(self.device)
-                y = self.net(x)
-
-                detections = y.data
-                scale = torch.Tensor([w, h, w, h])
-
-                for i in range(detections.size(1)):
-                    j = 0
-                    while detections[0, i, j, 0] > conf_th:
-                        score = detections[0, i, j, 0]
-                        pt = (detections[0, i, j, 1:] * scale).cpu().numpy()
-                        bbox = (pt[0], pt[1], pt[2], pt[3], score)
-                        bboxes = np.vstack((bboxes, bbox))
-                        j += 1
-
-            keep = nms_(bboxes, 0.1)
-            bboxes = bboxes[keep]
+            bboxes = [np.concatenate(frame_bboxes).astype('float64') for frame_bboxes in bboxes]
+            for b in range(len(bboxes)):
+                if len(xs) > 1:
+                    bboxes[b] = box_vote(bboxes[b], nms_th)
+                else:
+                    bboxes[b] = bboxes[b][nms_(bboxes[b], nms_th)]
 
         return bboxes
@@ -1,41 +1,13 @@
 import numpy as np
-from itertools import product as product
 import torch
 from torch.autograd import Function
 
+# the numpy box helpers moved to faceDetector.boxes so they load without torch, re-exported for older imports
+from ..boxes import nms_, iou_matrix, box_vote
 
-def nms_(dets, thresh):
-    """
-    Courtesy of Ross Girshick
-    [https://github.com/rbgirshick/py-faster-rcnn/blob/master/lib/nms/py_cpu_nms.py]
-    """
-    x1 = dets[:, 0]
-    y1 = dets[:, 1]
-    x2 = dets[:, 2]
-    y2 = dets[:, 3]
-    scores = dets[:, 4]
-
-    areas = (x2 - x1) * (y2 - y1)
-    order = scores.argsort()[::-1]
-
-    keep = []
-    while order.size > 0:
-        i = order[0]
-        keep.append(int(i))
-        xx1 = np.maximum(x1[i], x1[order[1:]])
-        yy1 = np.maximum(y1[i], y1[order[1:]])
-        xx2 = np.minimum(x2[i], x2[order[1:]])
-        yy2 = np.minimum(y2[i], y2[order[1:]])
-
-        w = np.maximum(0.0, xx2 - xx1)
-        h = np.maximum(0.0, yy2 - yy1)
-        inter = w * h
-        ovr = inter / (areas[i] + areas[order[1:]] - inter)
-
-        inds = np.where(ovr <= thresh)[0]
-        order = order[inds + 1]
-
-    return np.array(keep).astype(int)
+# anchor sizes and strides of the six detection layers, in network input pixels
+MIN_SIZES = [16, 32, 64, 128, 256, 512]
+STEPS = [4, 8, 16, 32, 64, 128]
 
 
 def decode(loc, priors, variances):
@@ -130,7 +102,7 @@ class Detect(object):
 
     def __init__(self, num_classes=2,
                     top_k=750, nms_thresh=0.3, conf_thresh=0.05,
-                    variance=[0.1, 0.2], nms_top_k=5000):
+                    variance=[0.1, 0.2], nms_top_k=5000, fast=True):
         
         self.num_classes = num_classes
         self.top_k = top_k
@@ -138,9 +110,56 @@ class Detect(object):
         self.conf_thresh = conf_thresh
         self.variance = variance
         self.nms_top_k = nms_top_k
+        self.fast = fast
 
     def forward(self, loc_data, conf_data, prior_data):
 
+        if self.fast:
+            return self.forward_fast(loc_data, conf_data, prior_data)
+        return self.forward_loop(loc_data, conf_data, prior_data)
+
+    def forward_fast(self, loc_data, conf_data, prior_data):
+        """Same output as forward_loop, computed for the whole batch at once with torchvision's batched NMS."""
+        # imported here, torchvision takes seconds to import and the numpy box helpers don't need it
+        from torchvision.ops import batched_nms
+
+        num = loc_data.size(0)
+        num_priors = prior_data.size(0)
+        num_fg = self.num_classes - 1
+
+        conf_preds = conf_data.view(num, num_priors, self.num_classes).transpose(2, 1)
+        batch_priors = prior_data.repeat(num, 1)
+
+        decoded_boxes = decode(loc_data.view(-1, 4), batch_priors, self.variance)
+        decoded_boxes = decoded_boxes.view(num, num_priors, 4)
+
+        output = torch.zeros(num, self.num_classes, self.top_k, 5, device=loc_data.device)
+
+        # the nms_top_k best scores of each (image, class) that also pass the confidence threshold
+        scores, prior_ids = conf_preds[:, 1:].topk(min(self.nms_top_k, num_priors), dim=2)
+        img_ids, cls_ids, ranks = torch.nonzero(scores > self.conf_thresh, as_tuple=True)
+        scores = scores[img_ids, cls_ids, ranks]
+        prior_ids = prior_ids[img_ids, cls_ids, ranks]
+        boxes = decoded_boxes[img_ids, prior_ids]
+        groups = img_ids * num_fg + cls_ids
+
+        # order the kept boxes by group, then decreasing score; like nms() ties go to the later prior first
+        keep = batched_nms(boxes, scores, groups, self.nms_thresh)
+        keep = keep[torch.sort(prior_ids[keep], descending=True, stable=True)[1]]
+        keep = keep[torch.sort(scores[keep], descending=True, stable=True)[1]]
+        keep = keep[torch.sort(groups[keep], stable=True)[1]]
+
+        counts = torch.bincount(groups[keep], minlength=num * num_fg)
+        starts = counts.cumsum(0) - counts
+        slots = torch.arange(keep.numel(), device=keep.device) - starts[groups[keep]]
+        keep, slots = keep[slots < self.top_k], slots[slots < self.top_k]
+
+        output[img_ids[keep], cls_ids[keep] + 1, slots] = torch.cat((scores[keep].unsqueeze(1), boxes[keep]), 1)
+
+        return output.cpu()
+
+    def forward_loop(self, loc_data, conf_data, prior_data):
+
         num = loc_data.size(0)
         num_priors = prior_data.size(0)
 
@@ -177,8 +196,8 @@ class PriorBox(object):
 
     def __init__(self, input_size, feature_maps,
                     variance=[0.1, 0.2],
-                    min_sizes=[16, 32, 64, 128, 256, 512],
-                    steps=[4, 8, 16, 32, 64, 128],
+                    min_sizes=MIN_SIZES,
+                    steps=STEPS,
                     clip=False):
 
         super(PriorBox, self).__init__()
@@ -197,19 +216,22 @@ class PriorBox(object):
         for k, fmap in enumerate(self.feature_maps):
             feath = fmap[0]
             featw = fmap[1]
-            for i, j in product(range(feath), range(featw)):
-                f_kw = self.imw / self.steps[k]
-                f_kh = self.imh / self.steps[k]
+            f_kw = self.imw / self.steps[k]
+            f_kh = self.imh / self.steps[k]
+
+            # rows are laid out in (i, j) order, same as product(range(feath), range(featw))
+            i, j = torch.meshgrid(torch.arange(feath, dtype=torch.float64),
+                                  torch.arange(featw, dtype=torch.float64), indexing='ij')
 
-                cx = (j + 0.5) / f_kw
-                cy = (i + 0.5) / f_kh
+            cx = (j + 0.5) / f_kw
+            cy = (i + 0.5) / f_kh
 
-                s_kw = self.min_sizes[k] / self.imw
-                s_kh = self.min_sizes[k] / self.imh
+            s_kw = torch.full_like(cx, self.min_sizes[k] / self.imw)
+            s_kh = torch.full_like(cy, self.min_sizes[k] / self.imh)
 
-                mean += [cx, cy, s_kw, s_kh]
+            mean += [torch.stack((cx, cy, s_kw, s_kh), dim=-1).view(-1, 4)]
 
-        output = torch.FloatTensor(mean).view(-1, 4)
+        output = torch.cat(mean, 0).float()
         
         if self.clip:
             output.clamp_(max=1, min=0)
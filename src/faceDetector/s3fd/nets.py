@@ -1,9 +1,14 @@
+from collections import OrderedDict
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.nn.init as init
 from .box_utils import Detect, PriorBox
 
+# input resolutions whose priors are kept; pyramid scales and roi crop sizes each add one
+PRIOR_CACHE_SIZE = 32
+
 
 class L2Norm(nn.Module):
 
@@ -19,15 +24,18 @@ class L2Norm(nn.Module):
         init.constant_(self.weight, self.gamma)
 
     def forward(self, x):
+        # normalize in float32, a half precision sum of squares overflows
+        dtype = x.dtype
+        x = x.float()
         norm = x.pow(2).sum(dim=1, keepdim=True).sqrt() + self.eps
         x = torch.div(x, norm)
-        out = self.weight.unsqueeze(0).unsqueeze(2).unsqueeze(3).expand_as(x) * x
-        return out
+        out = self.weight.float().unsqueeze(0).unsqueeze(2).unsqueeze(3).expand_as(x) * x
+        return out.to(dtype)
 
 
 class S3FDNet(nn.Module):
 
-    def __init__(self, device='cuda'):
+    def __init__(self, device='cpu'):
         super(S3FDNet, self).__init__()
         self.device = device
 
@@ -106,8 +114,18 @@ class S3FDNet(nn.Module):
         self.softmax = nn.Softmax(dim=-1)
         self.detect = Detect()
 
+        # priors only depend on the input resolution, so every frame of a video shares one entry
+        self.prior_cache = OrderedDict()
+
     def forward(self, x):
-        size = x.size()[2:]
+        loc, conf = self.heads(x)
+        return self.detect_from_heads(x.size()[2:], loc, conf)
+
+    def heads(self, x):
+        """Runs the backbone and the multibox heads, returning per-level loc and conf maps (NHWC).
+
+        This is the tensor-only part of the network, so it can be traced or compiled on its own.
+        """
         sources = list()
         loc = list()
         conf = list()
@@ -152,23 +170,39 @@ class S3FDNet(nn.Module):
             conf.append(self.conf[i](x).permute(0, 2, 3, 1).contiguous())
             loc.append(self.loc[i](x).permute(0, 2, 3, 1).contiguous())
 
+        return tuple(loc), tuple(conf)
+
+    def detect_from_heads(self, size, loc, conf):
         features_maps = []
         for i in range(len(loc)):
             feat = []
             feat += [loc[i].size(1), loc[i].size(2)]
             features_maps += [feat]
 
-        loc = torch.cat([o.view(o.size(0), -1) for o in loc], 1)
-        conf = torch.cat([o.view(o.size(0), -1) for o in conf], 1)
+        loc = torch.cat([o.view(o.size(0), -1) for o in loc], 1).float()
+        conf = torch.cat([o.view(o.size(0), -1) for o in conf], 1).float()
 
-        with torch.no_grad():
-            self.priorbox = PriorBox(size, features_maps)
-            self.priors = self.priorbox.forward()
+        self.priors = self.get_priors(size, features_maps, loc.device)
 
         output = self.detect.forward(
             loc.view(loc.size(0), -1, 4),
             self.softmax(conf.view(conf.size(0), -1, 2)),
-            self.priors.type(type(x.data)).to(self.device)
+            self.priors
         )
 
         return output
+
+    def get_priors(self, size, features_maps, device):
+        """Returns the prior boxes for an input resolution, building them only on first use.
+
+        The PRIOR_CACHE_SIZE most recently used resolutions are kept.
+        """
+        key = (tuple(size), tuple(tuple(f) for f in features_maps), str(device))
+        if key in self.prior_cache:
+            self.prior_cache.move_to_end(key)
+        else:
+            with torch.no_grad():
+                self.prior_cache[key] = PriorBox(size, features_maps).forward().to(device)
+            while len(self.prior_cache) > PRIOR_CACHE_SIZE:
+                self.prior_cache.popitem(last=False)
+        return self.prior_cache[key]
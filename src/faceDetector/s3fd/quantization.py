@@ -0,0 +1,56 @@
+import torch
+import torch.nn as nn
+import torch.ao.quantization as tq
+
+QUANTIZE_MODES = [None, 'int8', 'fp16']
+
+
+class QuantizedConv(nn.Module):
+    """Wraps a float conv so only the conv itself runs in int8, everything around it stays float."""
+
+    def __init__(self, conv):
+        super(QuantizedConv, self).__init__()
+        self.quant = tq.QuantStub()
+        self.conv = conv
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def prepare_int8(net, engine='x86'):
+    """Swaps the convs of vgg/extras/loc/conf for observed QuantizedConv wrappers (static int8).
+
+    The returned net has to see a few calibration batches before convert_int8 is called.
+    """
+    if engine not in torch.backends.quantized.supported_engines:
+        engine = torch.backends.quantized.supported_engines[-1]
+    torch.backends.quantized.engine = engine
+
+    qconfig = tq.get_default_qconfig(engine)
+    for layers in [net.vgg, net.extras, net.loc, net.conf]:
+        for k, layer in enumerate(layers):
+            if isinstance(layer, nn.Conv2d):
+                layers[k] = QuantizedConv(layer)
+                layers[k].qconfig = qconfig
+
+    return tq.prepare(net, inplace=True)
+
+
+def convert_int8(net):
+    return tq.convert(net.eval(), inplace=True)
+
+
+def quantize_net(net, mode):
+    """Applies a quantize mode to an eval-mode S3FDNet.
+
+    'fp16' casts the weights to half precision. 'int8' only inserts the observers,
+    so the net still needs calibration batches and convert_int8 (see S3FD.calibrate).
+    """
+    if mode not in QUANTIZE_MODES:
+        raise ValueError(f"Unknown quantize mode {mode!r}, expected one of {QUANTIZE_MODES}")
+    if mode == 'fp16':
+        return net.half()
+    if mode == 'int8':
+        return prepare_int8(net)
+    return net
@@ -1,25 +1,234 @@
 import sys, time, os, argparse, glob, subprocess, warnings, cv2, pickle, numpy, json
-from scipy import signal
-from shutil import rmtree
-from scipy.interpolate import interp1d
-from scenedetect import VideoStreamCv2, SceneManager, StatsManager
-from scenedetect.detectors import ContentDetector
-from faceDetector.s3fd import S3FD
+from itertools import islice, repeat
+from concurrent.futures import ProcessPoolExecutor
 
 from utils import save_data
+from video_frames import iter_video_frames, iter_video_frames_with_scenes, iter_frame_paths, make_scene_manager, \
+    video_fps, video_frame_count, sample_frames
+from detection_cache import DetectionCache, detect_cached, cached_frames, model_key
+from manifest import video_fingerprint
+from detection_store import save_detections, load_detections
+from keyframes import detect_keyframes, detect_roi
+from faceDetector.boxes import iou_matrix
 
+# torch, torchvision and scipy take seconds to import, they are imported by the functions that use them
 
-def inference_video(args):
-    DET = S3FD(device='cuda')
-    flist = sorted(glob.glob(os.path.join(args.savePath, 'pyframes', '*.jpg')))
-    dets = []
-    for fidx, fname in enumerate(flist):
-        image = cv2.imread(fname)
-        image_numpy = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        bboxes = DET.detect_faces(image_numpy, conf_th=0.9, scales=[args.facedetScale])
-        dets.append([{'frame': fidx, 'bbox': (bbox[:-1]).tolist(), 'conf': bbox[-1]} for bbox in bboxes])
-    save_data(dets, os.path.join(args.savePath, 'faces'))
-    return dets
+
+def build_detector(args):
+    from faceDetector.s3fd import S3FD
+
+    return S3FD(device=args.device, num_threads=args.threads, channels_last=args.channelsLast,
+                compile_mode=args.compileMode)
+
+
+def auto_scale(args, video_path, detector):
+    """Calibrates the detection scale on args.autoScaleFrames frames sampled over video_path (see calibrate_scale).
+
+    Falls back to args.facedetScale when the sampled frames have no faces.
+    """
+    from faceDetector.s3fd import calibrate_scale
+
+    images = [cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) for frame in sample_frames(video_path, args.autoScaleFrames)]
+    scale, recalls = calibrate_scale(detector, images, conf_th=args.confTh)
+    print("Scale calibration, recall per scale: " + ", ".join(f"{s}: {r:.3f}" for s, r in recalls.items()))
+    if scale is None:
+        print(f"No faces in the calibration frames, keeping scale {args.facedetScale}")
+        return args.facedetScale
+    print(f"Detecting faces at scale {scale}")
+    return scale
+
+
+def detection_scales(args):
+    """[args.facedetScale], or the args.pyramidScales needed for faces of at least args.minFaceSize pixels."""
+    if not args.pyramidScales:
+        return [args.facedetScale]
+    from faceDetector.s3fd import pyramid_scales
+
+    return pyramid_scales(args.pyramidScales, args.minFaceSize)
+
+
+def inference_video(args, video_path, frame_step, frames=None, detector=None, manifest=None):
+    """Runs face detection over frames, an iterable of (frame_idx, BGR frame); by default every frame_step-th
+    frame of video_path, decoded with args.stream or read back from the JPEGs extracted to args.savePath.
+
+    frame_idx is the index in the source video. Every detection records it along with its timestamp
+    and the sampled frame position. The detections are saved to the columnar store in savePath/faces/
+    and returned as Detections.
+
+    A detector that is already loaded can be passed in to avoid reloading the weights for every video.
+    With a manifest, detection resumes after the frames checkpointed by an interrupted run and is
+    checkpointed every args.checkpointEvery frames. With args.cacheDir, frames detected by any earlier
+    run with the same video and detector settings are served from the detection cache.
+
+    With args.keyframeInterval, the detector only runs on keyframes (at most keyframeInterval frames
+    apart, at scene cuts and when optical flow loses the faces) and boxes are propagated in between.
+    With args.roiInterval, the full frame is detected every roiInterval frames and only padded crops
+    around the last boxes in between.
+
+    With args.pyramidScales, every frame is detected at those scales (see detection_scales) and the
+    boxes of all scales are merged by box voting.
+    """
+    from detection_pipeline import detect_pipelined, StageTimer
+
+    DET = detector if detector is not None else build_detector(args)
+    scales = detection_scales(args)
+    dets = manifest.resume_detections() if manifest is not None else []
+    fps = video_fps(video_path)
+    # frames decoded here only to be detected can be skipped altogether when they are all cached
+    decode_only = frames is None and args.stream and not args.saveFrames
+    if frames is None and args.stream:
+        save_dir = os.path.join(args.savePath, 'pyframes') if args.saveFrames else None
+        frames = iter_video_frames(video_path, frame_step, save_dir, start=len(dets) * frame_step)
+    elif frames is None:
+        # the extracted JPEGs are every frame_step-th frame of the video
+        frames = ((k * frame_step, path) for k, path in
+                  islice(iter_frame_paths(os.path.join(args.savePath, 'pyframes')), len(dets), None))
+    else:
+        frames = islice(frames, len(dets), None)
+
+    cache, cached, new, served = None, {}, [], 0
+    # propagated boxes and crop detections are not full frame detections, those runs don't use the cache
+    if args.cacheDir and not args.keyframeInterval and not args.roiInterval:
+        cache = DetectionCache(args.cacheDir, int(args.cacheSize * (1 << 30)))
+        # frames read back from extracted JPEGs are not the decoded frames, they get their own key
+        video_key = video_fingerprint(video_path) + ('' if args.stream else f':pyframes:{frame_step}')
+        # a pyramid is keyed by its scales on top of the model, the scale column keeps facedetScale
+        detector_key = model_key(DET) + (f":pyramid:{','.join(map(str, scales))}" if args.pyramidScales else '')
+        cache_key = (video_key, detector_key, args.facedetScale, args.confTh)
+        cached = cache.get_all(*cache_key)
+
+    def detect(misses):
+        return detect_pipelined(DET, misses, args.batchSize, conf_th=args.confTh, scales=scales,
+                                workers=args.workers, queue_depth=args.queueDepth, timer=timer)
+
+    resumed = checkpointed = len(dets)
+    timer = StageTimer()
+    start = time.time()
+    keyframe_stats, roi_stats = {}, {}
+    scene_path = os.path.join(args.savePath, 'scene.pckl')
+    scene_cuts = []
+    if os.path.isfile(scene_path) and (manifest is None or manifest.is_done('scenes')):
+        scene_cuts = [scene[0].get_frames() for scene in pickle.load(open(scene_path, 'rb'))]
+    if args.keyframeInterval:
+        results = ((frame_idx, bboxes, False) for frame_idx, bboxes, _ in
+                   detect_keyframes(DET, frames, scene_cuts, args.keyframeInterval, args.minTrackerConf,
+                                    conf_th=args.confTh, scales=scales, stats=keyframe_stats))
+    elif args.roiInterval:
+        results = ((frame_idx, bboxes, False) for frame_idx, bboxes, _ in
+                   detect_roi(DET, frames, scene_cuts, args.roiInterval, args.roiPad, conf_th=args.confTh,
+                              scales=scales, stats=roi_stats))
+    else:
+        covered = None
+        if cached and decode_only:
+            covered = cached_frames(cached, len(dets) * frame_step, video_frame_count(video_path), frame_step)
+        if covered is not None:
+            results = ((frame_idx, cached[frame_idx], True) for frame_idx in covered)
+        else:
+            results = detect_cached(detect, frames, cached)
+    try:
+        for frame_idx, bboxes, hit in results:
+            fidx = len(dets)
+            timestamp = frame_idx / fps if fps else float('nan')
+            dets.append([{'frame': fidx, 'source_frame': int(frame_idx), 'time': timestamp,
+                          'bbox': (bbox[:-1]).tolist(), 'conf': bbox[-1]} for bbox in bboxes])
+            served += hit
+            if cache is not None and not hit:
+                new.append((frame_idx, bboxes))
+            checkpoint = manifest is not None and len(dets) - checkpointed >= args.checkpointEvery
+            # the cache is flushed at least as often as the manifest checkpoints
+            if cache is not None and (len(new) >= 256 or checkpoint):
+                cache.put_many(*cache_key, new)
+                new = []
+            if checkpoint:
+                manifest.checkpoint_detections(dets[checkpointed:])
+                checkpointed = len(dets)
+    finally:
+        # an interrupted run keeps what it detected
+        if cache is not None:
+            cache.put_many(*cache_key, new)
+            cache.close()
+    if cache is not None:
+        print(f"{served} frames served from the detection cache")
+    if keyframe_stats:
+        saved = keyframe_stats['frames'] - keyframe_stats['detector_calls']
+        print(f"Detector ran on {keyframe_stats['detector_calls']} of {keyframe_stats['frames']} frames, "
+              f"{saved} calls saved ({100 * saved / max(keyframe_stats['frames'], 1):.1f}%)")
+    if roi_stats:
+        print(f"Full frame detection on {roi_stats['full_frames']} of {roi_stats['frames']} frames, "
+              f"{roi_stats['passes']} detector passes on "
+              f"{100 * roi_stats['pixels'] / max(roi_stats['frame_pixels'], 1):.1f}% of the full-frame input pixels")
+    timer.report(len(dets) - resumed, time.time() - start)
+    faces = save_detections(dets, args.savePath, frame_step, fps)
+    if manifest is not None:
+        manifest.finish_detections(['faces'])
+    return faces
+
+
+def detect_scenes_and_faces(args, video_path, frame_step, detector=None, manifest=None):
+    """Decodes the video once, scene detection sees every frame and face detection every frame_step-th one."""
+    scene_manager = make_scene_manager()
+    save_dir = os.path.join(args.savePath, 'pyframes') if args.saveFrames else None
+
+    frames = iter_video_frames_with_scenes(video_path, scene_manager, frame_step, save_dir)
+    dets = inference_video(args, video_path, frame_step, frames, detector, manifest)
+
+    scene_list = scene_manager.get_scene_list(start_in_scene=True)
+    save_data(scene_list, os.path.join(args.savePath, 'scene'))
+    if manifest is not None:
+        manifest.mark_done('scenes', ['scene.pckl'])
+
+    return scene_list, dets
+
+
+def calibrate(args, video_path, manifest, detector=None):
+    """Sets args.facedetScale with args.autoScale, returns the detector (built here if it had to be for that).
+
+    The calibrated scale is saved to savePath/scale.json, a rerun reads it back instead of calibrating again.
+    facedetScale is the fallback when the sampled frames have no faces.
+    """
+    scale_path = os.path.join(args.savePath, 'scale.json')
+    if args.autoScale and manifest.is_done('scale'):
+        with open(scale_path) as f:
+            args.facedetScale = json.load(f)['facedetScale']
+    elif args.autoScale:
+        if detector is None:
+            detector = build_detector(args)
+        args.facedetScale = auto_scale(args, video_path, detector)
+        with open(scale_path, 'w') as f:
+            json.dump({'facedetScale': args.facedetScale}, f)
+        manifest.mark_done('scale', ['scale.json'])
+    return detector
+
+
+def detect_stages(args, video_path, frame_step, manifest, detector=None):
+    """Scale calibration, frame extraction, scene and face detection of video_path, sampling every frame_step-th frame.
+
+    Stages manifest has marked done are skipped. Scenes and faces are detected on a single decode of the
+    video when they both have to run and nothing needs the scene cuts up front. Returns the Detections.
+    """
+    from extract_frames_scenes import extract_frames, scene_detect
+
+    scenes_done, faces_done = manifest.is_done('scenes'), manifest.is_done('faces')
+    detector = calibrate(args, video_path, manifest, detector)
+
+    # keyframe and roi detection need the scene cuts up front and fast scene detection decodes the video
+    # on its own, none of them run in the single pass
+    if (args.stream and not scenes_done and not faces_done and not args.keyframeInterval and not args.roiInterval
+            and not args.fastScenes):
+        scene_list, faces = detect_scenes_and_faces(args, video_path, frame_step, detector, manifest)
+        return faces
+
+    if not args.stream and not faces_done and not manifest.is_done('frames'):
+        extract_frames(video_path, args.savePath, frame_step)
+        manifest.mark_done('frames', ['pyframes'])
+
+    if not scenes_done:
+        scene_detect(video_path, args.savePath, args.fastScenes, args.sceneFrameSkip)
+        manifest.mark_done('scenes', ['scene.pckl'])
+
+    if faces_done:
+        return load_detections(args.savePath)
+    return inference_video(args, video_path, frame_step, detector=detector, manifest=manifest)
 
 
 def bb_intersection_over_union(boxA, boxB):
@@ -31,42 +240,124 @@ def bb_intersection_over_union(boxA, boxB):
     return inter_area / float(box_a_area + box_b_area - inter_area)
 
 
-def track_shot(args, scene_faces):
-    iou_thres = 0.5
-    tracks = []
-    while True:
-        track = []
-        for frame_faces in scene_faces:
-            for face in frame_faces:
-                if not track:
-                    track.append(face)
-                    frame_faces.remove(face)
-                elif face['frame'] - track[-1]['frame'] <= args.numFailedDet:
-                    if bb_intersection_over_union(face['bbox'], track[-1]['bbox']) > iou_thres:
-                        track.append(face)
-                        frame_faces.remove(face)
-        if not track:
-            break
-        elif len(track) > args.minTrack:
-            frame_num = numpy.array([f['frame'] for f in track])
-            bboxes = numpy.array([numpy.array(f['bbox']) for f in track])
+def match_tracks(iou, iou_thres=0.5, matching='greedy'):
+    """Assigns the boxes of a frame (columns of iou) to the active tracks (rows), returns (row, col) pairs.
+
+    'greedy' lets the tracks pick their best box in the order they were started, 'hungarian'
+    maximizes the total IoU. Pairs must overlap by more than iou_thres.
+    """
+    if matching == 'hungarian':
+        from scipy.optimize import linear_sum_assignment
+
+        rows, cols = linear_sum_assignment(-iou)
+        keep = iou[rows, cols] > iou_thres
+        return list(zip(rows[keep], cols[keep]))
+
+    pairs = []
+    taken = numpy.zeros(iou.shape[1], dtype=bool)
+    for row in range(iou.shape[0]):
+        ious = numpy.where(taken, -1.0, iou[row])
+        col = ious.argmax()
+        if ious[col] > iou_thres:
+            pairs.append((row, col))
+            taken[col] = True
+    return pairs
+
+
+def interpolate_track(frame_num, bboxes, frame_i):
+    """Linear interpolation of the (n, 4) track bboxes at frame_i, all four coordinates in one np.interp call."""
+    # the coordinates are laid end to end along the frame axis, span frames apart, so they never mix
+    span = frame_num[-1] - frame_num[0] + 1
+    offsets = numpy.arange(bboxes.shape[1])[:, None] * span
+    bboxes_i = numpy.interp((frame_i + offsets).ravel(), (frame_num + offsets).ravel(), bboxes.T.ravel())
+    return bboxes_i.reshape(bboxes.shape[1], -1).T
+
+
+def track_shot(args, scene_faces, iou_thres=0.5, matching='greedy'):
+    """Single pass online IoU tracker over the Detections of one scene.
+
+    A track stays active while it has been missing for at most numFailedDet seconds. The boxes of each
+    frame are matched to the last boxes of the active tracks through one IoU matrix, unmatched boxes
+    start new tracks. Tracks detected for more than minTrack seconds are interpolated over their
+    missing sampled frames, and carry the source frame and timestamp of every frame.
+    """
+    frame_step, fps = scene_faces.meta['frame_step'], scene_faces.meta['fps']
+    if not fps:
+        raise ValueError("Tracking needs the video fps to turn numFailedDet and minTrack seconds into frames, "
+                         "but the detections have no fps")
+    # the tracker counts sampled frames, a sampled frame lasts frame_step / fps seconds
+    max_gap = round(args.numFailedDet * fps / frame_step, 6)
+    min_dets = round(args.minTrack * fps / frame_step, 6)
+
+    frames = scene_faces.columns['frame']
+    bboxes = scene_faces.bboxes()[:, :4]
+    offsets = scene_faces.offsets
+
+    tracks = []  # detection rows of every track, in the order they were started
+    active = []  # indices into tracks
+    for lo, hi in zip(offsets[:-1].tolist(), offsets[1:].tolist()):
+        if lo == hi:
+            continue
+        frame = frames[lo]
+        active = [t for t in active if frame - frames[tracks[t][-1]] <= max_gap]
+
+        matched = numpy.zeros(hi - lo, dtype=bool)
+        if active:
+            iou = iou_matrix(bboxes[[tracks[t][-1] for t in active]], bboxes[lo:hi])
+            for row, col in match_tracks(iou, iou_thres, matching):
+                tracks[active[row]].append(lo + col)
+                matched[col] = True
+        for col in numpy.flatnonzero(~matched):
+            active.append(len(tracks))
+            tracks.append([lo + col])
+
+    all_tracks = []
+    for track in tracks:
+        if len(track) > min_dets:
+            frame_num = frames[track]
+            track_bboxes = bboxes[track]
             frame_i = numpy.arange(frame_num[0], frame_num[-1] + 1)
-            bboxes_i = numpy.stack([interp1d(frame_num, bboxes[:, ij])(frame_i) for ij in range(4)], axis=1)
+            bboxes_i = interpolate_track(frame_num, track_bboxes, frame_i)
             if max(numpy.mean(bboxes_i[:, 2] - bboxes_i[:, 0]),
                    numpy.mean(bboxes_i[:, 3] - bboxes_i[:, 1])) > args.minFaceSize:
-                tracks.append({'frame': frame_i, 'bbox': bboxes_i})
-    return tracks
+                source_i = frame_i * frame_step
+                all_tracks.append({'frame': frame_i, 'bbox': bboxes_i, 'source_frame': source_i, 'time': source_i / fps})
+    return all_tracks
 
 
 def track_faces(args, faces):
-    all_tracks = []
+    """Tracks the faces of every scene at least minTrack seconds long.
+
+    Scenes are in source frames, they are mapped to the sampled frames faces was detected on.
+    The fps comes from faces, or from the video for detections saved without one; raises ValueError
+    if neither has it.
+    Boxes are matched to the tracks with args.trackMatching (see match_tracks).
+    With args.trackProcesses > 1 the scenes are tracked in a process pool; the tracks are
+    returned in scene order either way.
+    """
     scene_list = pickle.load(open(os.path.join(args.savePath, 'scene.pckl'), 'rb'))
+    if not faces.meta.get('fps'):
+        faces.meta['fps'] = video_fps(args.videoPath)
+    fps = faces.meta['fps']
+    if not fps:
+        raise ValueError(f"Tracking needs the video fps, but neither the detections nor {args.videoPath} have one")
 
+    shots = []
     for shot in scene_list:
         start_frame, end_frame = shot[0].get_frames(), shot[1].get_frames()
-        if end_frame - start_frame >= args.minTrack:
-            scene_faces = faces[start_frame:end_frame]
-            all_tracks.extend(track_shot(args, scene_faces))
+        if (end_frame - start_frame) / fps >= args.minTrack:
+            start_frame, end_frame = faces.scene_range(start_frame, end_frame)
+            shots.append(faces[start_frame:end_frame])
+
+    processes = min(args.trackProcesses, len(shots))
+    if processes > 1:
+        with ProcessPoolExecutor(processes) as pool:
+            shot_tracks = list(pool.map(track_shot, repeat(args), shots, repeat(0.5), repeat(args.trackMatching),
+                                        chunksize=max(1, len(shots) // (4 * processes))))
+    else:
+        shot_tracks = [track_shot(args, shot, matching=args.trackMatching) for shot in shots]
+
+    all_tracks = [track for tracks in shot_tracks for track in tracks]
     save_data(all_tracks, os.path.join(args.savePath, 'tracks'))
     return all_tracks
 
@@ -78,8 +369,30 @@ def main():
     args = argparse.Namespace(
         output_folder="/home/tim/Work/nexa/nexa-face-detection/data/out/test_snippet_timestamps_2",
         facedetScale=0.5,
-        minTrack=15,
-        numFailedDet=5,
+        pyramidScales=None,
+        autoScale=False,
+        autoScaleFrames=16,
+        batchSize=8,
+        device='auto',
+        threads=None,
+        channelsLast=False,
+        compileMode=None,
+        stream=False,
+        saveFrames=False,
+        workers=2,
+        queueDepth=4,
+        confTh=0.9,
+        checkpointEvery=250,
+        cacheDir=None,
+        cacheSize=2,
+        keyframeInterval=0,
+        minTrackerConf=0.6,
+        roiInterval=0,
+        roiPad=1.0,
+        trackProcesses=1,
+        trackMatching='greedy',
+        minTrack=0.6,
+        numFailedDet=0.2,
         minFaceSize=50,
         cropScale=0.5,
         start=10,
@@ -89,10 +402,10 @@ def main():
     # args.videoPath = args.input_video
     args.savePath = args.output_folder
 
-    faces = inference_video(args)
+    faces = inference_video(args, args.videoPath, args.frameStep)
 
     # load faces
-    faces = pickle.load(open(os.path.join(args.savePath, 'faces.pckl'), 'rb'))
+    faces = load_detections(args.savePath)
 
     track_faces(args, faces)
 
@@ -0,0 +1,224 @@
+import cv2
+import numpy as np
+
+
+class BoxPropagator(object):
+    """Carries face boxes from one frame to the next with pyramidal Lucas-Kanade optical flow.
+
+    Corners are picked inside every box on the keyframe and tracked forward and back; a point is
+    kept while its forward-backward error stays under max_fb_error pixels. A box moves by the median
+    displacement of its points, and its confidence is the fraction of its keyframe points still kept.
+    A box without any corners (a flat, textureless patch) can't be followed; it stays where it is until
+    the next keyframe and doesn't count towards the confidence.
+    Flow runs on grayscale frames resized by flow_scale.
+    """
+
+    def __init__(self, flow_scale=0.5, max_corners=20, max_fb_error=1.0):
+        self.flow_scale = flow_scale
+        self.max_corners = max_corners
+        self.max_fb_error = max_fb_error
+        self.lk_params = dict(winSize=(15, 15), maxLevel=2,
+                              criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+        self.gray = None
+        self.bboxes = np.zeros((0, 5))
+        self.points = []
+        self.n_initial = []
+
+    def to_gray(self, frame):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(gray, None, fx=self.flow_scale, fy=self.flow_scale, interpolation=cv2.INTER_AREA)
+
+    def reset(self, gray, bboxes):
+        """Starts tracking bboxes (detector output, (n, 5)) from the keyframe gray."""
+        self.gray = gray
+        self.bboxes = np.array(bboxes, dtype=np.float64).reshape(-1, 5)
+        self.points = []
+        height, width = gray.shape
+        for x1, y1, x2, y2 in self.bboxes[:, :4] * self.flow_scale:
+            mask = np.zeros_like(gray)
+            mask[max(0, int(y1)):min(height, int(y2)), max(0, int(x1)):min(width, int(x2))] = 255
+            corners = cv2.goodFeaturesToTrack(gray, self.max_corners, 0.01, 3, mask=mask)
+            self.points.append(corners.reshape(-1, 2) if corners is not None else np.zeros((0, 2), np.float32))
+        self.n_initial = [len(p) for p in self.points]
+
+    def step(self, gray):
+        """Moves the boxes to gray, returns (bboxes, confidence) with the lowest confidence of any box."""
+        if len(self.bboxes) == 0:
+            self.gray = gray
+            return self.bboxes, 1.0
+        counts = [len(p) for p in self.points]
+        if sum(counts) == 0:
+            self.gray = gray
+            return self.bboxes.copy(), 0.0 if any(self.n_initial) else 1.0
+
+        p0 = np.concatenate(self.points).astype(np.float32).reshape(-1, 1, 2)
+        p1, st, _ = cv2.calcOpticalFlowPyrLK(self.gray, gray, p0, None, **self.lk_params)
+        p0_back, st_back, _ = cv2.calcOpticalFlowPyrLK(gray, self.gray, p1, None, **self.lk_params)
+        fb_error = np.linalg.norm(p0 - p0_back, axis=2).ravel()
+        good = (st.ravel() == 1) & (st_back.ravel() == 1) & (fb_error < self.max_fb_error)
+        p0, p1 = p0.reshape(-1, 2), p1.reshape(-1, 2)
+
+        confidence = 1.0
+        bounds = np.cumsum([0] + counts)
+        for k, (lo, hi) in enumerate(zip(bounds[:-1], bounds[1:])):
+            keep = good[lo:hi]
+            if self.n_initial[k]:
+                confidence = min(confidence, keep.sum() / self.n_initial[k])
+            if keep.any():
+                shift = np.median(p1[lo:hi][keep] - p0[lo:hi][keep], axis=0) / self.flow_scale
+                self.bboxes[k, [0, 2]] += shift[0]
+                self.bboxes[k, [1, 3]] += shift[1]
+            self.points[k] = p1[lo:hi][keep]
+
+        self.gray = gray
+        return self.bboxes.copy(), confidence
+
+
+def crossed_cut(cuts, prev_idx, frame_idx):
+    """True if a scene of the sorted cuts starts after source frame prev_idx, up to frame_idx."""
+    return np.searchsorted(cuts, frame_idx, 'right') > np.searchsorted(cuts, prev_idx, 'right')
+
+
+def detect_keyframes(detector, frames, scene_cuts=(), keyframe_interval=10, min_confidence=0.6, conf_th=0.9,
+                     scales=[1], nms_th=0.1, stats=None):
+    """Runs S3FD only on keyframes and propagates its boxes with optical flow in between.
+
+    frames yields (frame_idx, frame) with a BGR image or the path of one, like detect_pipelined. A frame
+    is a keyframe when it is the first one, when keyframe_interval frames went by since the last one,
+    when a scene starts at a source frame in scene_cuts since the previous frame, or when the propagated
+    boxes fall under min_confidence. Propagated boxes keep the score of their detection.
+
+    Yields (frame_idx, bboxes, detected). stats, if given, counts 'frames' and 'detector_calls'.
+    """
+    stats = stats if stats is not None else {}
+    stats.setdefault('frames', 0)
+    stats.setdefault('detector_calls', 0)
+    cuts = np.sort(np.asarray(scene_cuts, dtype=np.int64))
+
+    propagator = BoxPropagator()
+    prev_idx = None
+    since_keyframe = 0
+    for frame_idx, frame in frames:
+        if isinstance(frame, str):
+            frame = cv2.imread(frame)
+        gray = propagator.to_gray(frame)
+
+        detect = prev_idx is None or since_keyframe >= keyframe_interval or crossed_cut(cuts, prev_idx, frame_idx)
+        if not detect:
+            bboxes, confidence = propagator.step(gray)
+            detect = confidence < min_confidence
+
+        if detect:
+            bboxes = detector.detect_faces(frame, conf_th=conf_th, scales=scales, nms_th=nms_th, bgr=True)
+            propagator.reset(gray, bboxes)
+            since_keyframe = 0
+            stats['detector_calls'] += 1
+
+        since_keyframe += 1
+        stats['frames'] += 1
+        prev_idx = frame_idx
+        yield frame_idx, bboxes, detect
+
+
+def roi_crops(bboxes, frame_shape, pad=1.0, multiple=1):
+    """Crop windows (x0, y0, x1, y1) around bboxes, padded by pad box sizes on every side.
+
+    Windows are grown to a multiple of multiple pixels per side, so crops of similar faces come out
+    the same size and can share a forward pass, shifted back inside the frame and clipped to it.
+    Overlapping ones are merged so no pixel goes through the network twice.
+    """
+    height, width = frame_shape[:2]
+
+    def fit(x0, y0, x1, y1):
+        w = min(width, -(-(x1 - x0) // multiple) * multiple)
+        h = min(height, -(-(y1 - y0) // multiple) * multiple)
+        x0 = min(max(0, x0 - (w - (x1 - x0)) // 2), width - w)
+        y0 = min(max(0, y0 - (h - (y1 - y0)) // 2), height - h)
+        return [x0, y0, x0 + w, y0 + h]
+
+    crops = []
+    for x1, y1, x2, y2 in np.asarray(bboxes)[:, :4]:
+        cx, cy = (x1 + x2) / 2, (y1 + y2) / 2
+        half = max(x2 - x1, y2 - y1) * (0.5 + pad)
+        crops.append(fit(max(0, int(cx - half)), max(0, int(cy - half)),
+                         min(width, int(np.ceil(cx + half))), min(height, int(np.ceil(cy + half)))))
+
+    merged = True
+    while merged and len(crops) > 1:
+        merged = False
+        for i in range(len(crops)):
+            for j in range(i + 1, len(crops)):
+                a, b = crops[i], crops[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    crops[i] = fit(min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                    del crops[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return crops
+
+
+def detect_roi(detector, frames, scene_cuts=(), full_interval=10, pad=1.0, conf_th=0.9, scales=[1], nms_th=0.1,
+               min_input=64, multiple=32, stats=None):
+    """Runs S3FD on the full frame periodically and only on crops around the last boxes in between.
+
+    frames yields (frame_idx, frame) like detect_keyframes. The full frame is detected on the first
+    frame, every full_interval frames, at scene cuts and whenever the previous frame had no faces.
+    Other frames are detected on the roi_crops of the previous frame's boxes and the boxes are mapped
+    back to frame coordinates. A crop that would come out under min_input network pixels at scales
+    (the network needs at least 32) is detected at proportionally higher scales instead of being
+    grown, and crops of the same size are detected in one batch.
+
+    Yields (frame_idx, bboxes, full). stats, if given, counts 'frames', 'full_frames', 'passes'
+    (detector calls), 'pixels' (network input pixels) and 'frame_pixels' (the network input pixels of
+    detecting every frame in full).
+    """
+    stats = stats if stats is not None else {}
+    for key in ['frames', 'full_frames', 'passes', 'pixels', 'frame_pixels']:
+        stats.setdefault(key, 0)
+    cuts = np.sort(np.asarray(scene_cuts, dtype=np.int64))
+
+    def input_pixels(w, h, crop_scales, n=1):
+        return n * sum(int(w * s) * int(h * s) for s in crop_scales)
+
+    bboxes = np.zeros((0, 5))
+    prev_idx = None
+    since_full = 0
+    for frame_idx, frame in frames:
+        if isinstance(frame, str):
+            frame = cv2.imread(frame)
+        height, width = frame.shape[:2]
+
+        full = (prev_idx is None or since_full >= full_interval or len(bboxes) == 0
+                or crossed_cut(cuts, prev_idx, frame_idx))
+        if full:
+            bboxes = detector.detect_faces(frame, conf_th=conf_th, scales=scales, nms_th=nms_th, bgr=True)
+            since_full = 0
+            stats['full_frames'] += 1
+            stats['passes'] += 1
+            stats['pixels'] += input_pixels(width, height, scales)
+        else:
+            by_size = {}
+            for x0, y0, x1, y1 in roi_crops(bboxes, frame.shape, pad, multiple):
+                by_size.setdefault((x1 - x0, y1 - y0), []).append((x0, y0))
+            found = []
+            for (w, h), corners in by_size.items():
+                boost = max(1.0, min_input / (min(w, h) * min(scales)))
+                crop_scales = [s * boost for s in scales]
+                crop_bboxes = detector.detect_faces_batch([frame[y0:y0 + h, x0:x0 + w] for x0, y0 in corners],
+                                                          conf_th=conf_th, scales=crop_scales, nms_th=nms_th, bgr=True)
+                for (x0, y0), boxes in zip(corners, crop_bboxes):
+                    boxes[:, [0, 2]] += x0
+                    boxes[:, [1, 3]] += y0
+                    found.append(boxes)
+                stats['passes'] += 1
+                stats['pixels'] += input_pixels(w, h, crop_scales, len(corners))
+            # the crops don't overlap, so neither do their detections
+            bboxes = np.concatenate(found)
+
+        since_full += 1
+        stats['frames'] += 1
+        stats['frame_pixels'] += input_pixels(width, height, scales)
+        prev_idx = frame_idx
+        yield frame_idx, bboxes, full
@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+
+MANIFEST_NAME = 'manifest.json'
+CHECKPOINT_NAME = 'faces.checkpoint'
+
+
+def video_fingerprint(video_path, chunk_size=1 << 20):
+    """Content hash of a video: its size plus the first, middle and last chunk_size bytes.
+
+    Hashing the whole file would cost as much as a decode for hours-long recordings.
+    """
+    size = os.path.getsize(video_path)
+    digest = hashlib.sha1(str(size).encode())
+    with open(video_path, 'rb') as f:
+        for offset in sorted({0, max(0, size // 2 - chunk_size // 2), max(0, size - chunk_size)}):
+            f.seek(offset)
+            digest.update(f.read(chunk_size))
+    return digest.hexdigest()
+
+
+def run_key(video_path, params):
+    """Key of a run: the video content plus the parameters that change the detections."""
+    digest = hashlib.sha1(video_fingerprint(video_path).encode())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class Manifest(object):
+    """Per output folder record of the finished stages of a run, so a rerun can skip them.
+
+    Entries are keyed by run_key(video, params); a different video or different parameters start
+    from scratch. Face detection is checkpointed to faces.checkpoint, an append-only file of pickled
+    detection chunks, and the number of frames known to be in it is kept in the manifest.
+    """
+
+    def __init__(self, save_path, video_path, params):
+        self.save_path = save_path
+        self.path = os.path.join(save_path, MANIFEST_NAME)
+        self.checkpoint_path = os.path.join(save_path, CHECKPOINT_NAME)
+        self.key = run_key(video_path, params)
+
+        data = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                data = json.load(f)
+
+        if data.get('key') != self.key:
+            data = {'key': self.key, 'video': video_path, 'params': params, 'stages': {}, 'detected_frames': 0}
+            if os.path.isfile(self.checkpoint_path):
+                os.remove(self.checkpoint_path)
+        self.data = data
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f, indent=4)
+        os.replace(tmp_path, self.path)
+
+    def is_done(self, stage, params=None):
+        """True if stage finished with the same params and all its outputs still exist."""
+        entry = self.data['stages'].get(stage)
+        if entry is None or entry.get('params') != params:
+            return False
+        return all(os.path.exists(os.path.join(self.save_path, out)) for out in entry['outputs'])
+
+    def mark_done(self, stage, outputs, params=None):
+        self.data['stages'][stage] = {'finished': time.time(), 'outputs': outputs, 'params': params}
+        self.save()
+
+    def resume_detections(self):
+        """Detections of the frames checkpointed so far, an empty list when starting fresh."""
+        n_frames = self.data['detected_frames']
+        dets = []
+        if n_frames == 0 or not os.path.isfile(self.checkpoint_path):
+            self.data['detected_frames'] = 0
+            return dets
+
+        with open(self.checkpoint_path, 'rb') as f:
+            while len(dets) < n_frames:
+                dets.extend(pickle.load(f))
+            end = f.tell()
+        # anything after the last recorded chunk was written by a run that died mid-checkpoint
+        with open(self.checkpoint_path, 'r+b') as f:
+            f.truncate(end)
+
+        print(f"Resuming face detection after {len(dets)} frames")
+        return dets
+
+    def checkpoint_detections(self, new_dets):
+        """Appends the detections of newly processed frames to the checkpoint."""
+        if not new_dets:
+            return
+        with open(self.checkpoint_path, 'ab') as f:
+            pickle.dump(new_dets, f)
+            f.flush()
+            os.fsync(f.fileno())
+        self.data['detected_frames'] += len(new_dets)
+        self.save()
+
+    def finish_detections(self, outputs):
+        self.mark_done('faces', outputs)
+        if os.path.isfile(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
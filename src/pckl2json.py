@@ -1,8 +1,13 @@
 import os
 import pickle
 import json
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 
+from detection_store import STORE_NAME, load_detections
+
+FORMATS = ['jsonl', 'json']
+
 
 def custom_serializer(obj):
     """
@@ -16,28 +21,108 @@ def custom_serializer(obj):
         return str(obj)  # Fallback to string representation
 
 
-def convert_pickles_to_json(input_folder, output_folder):
+def to_jsonable(obj):
+    """Converts NumPy arrays and scalars inside dicts/lists up front, one tolist() per array."""
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, dict):
+        return {k: to_jsonable(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_jsonable(v) for v in obj]
+    return obj
+
+
+def write_records(records, output_path, fmt='jsonl', indent=None):
+    """Writes records one at a time, as JSON Lines or as the items of a JSON array.
+
+    indent only applies to 'json', JSON Lines keeps every record on one line.
+    """
+    separators = (',', ':') if fmt == 'jsonl' or indent is None else None
+    with open(output_path, 'w') as f:
+        if fmt == 'jsonl':
+            for record in records:
+                f.write(json.dumps(to_jsonable(record), default=custom_serializer, separators=separators))
+                f.write('\n')
+            return
+
+        f.write('[')
+        for k, record in enumerate(records):
+            f.write(',\n' if k else '\n')
+            f.write(json.dumps(to_jsonable(record), default=custom_serializer, indent=indent, separators=separators))
+        f.write('\n]\n')
+
+
+def convert_pickle(input_path, output_path, fmt='jsonl', indent=None):
+    with open(input_path, 'rb') as pkl_file:
+        data = pickle.load(pkl_file)
+
+    if fmt == 'json' and not isinstance(data, (list, tuple)):
+        with open(output_path, 'w') as json_file:
+            json.dump(to_jsonable(data), json_file, default=custom_serializer, indent=indent)
+    else:
+        # a list becomes one record per item (frame, scene or track)
+        write_records(data if isinstance(data, (list, tuple)) else [data], output_path, fmt, indent)
+
+
+def iter_detection_frames(input_folder, chunk_frames=4096):
+    """Per-frame face lists of the columnar store, materialized chunk_frames frames at a time."""
+    dets = load_detections(input_folder)
+    for start in range(0, len(dets), chunk_frames):
+        yield from dets[start:start + chunk_frames].to_frames()
+
+
+def convert_detections(input_folder, output_path, fmt='jsonl', indent=None):
+    write_records(iter_detection_frames(input_folder), output_path, fmt, indent)
+
+
+def _convert(task):
+    name, convert, args = task
+    try:
+        convert(*args)
+        return f"Converted {name} to JSON."
+    except Exception as e:
+        return f"Error processing {name}: {e}"
+
+
+def convert_pickles_to_json(input_folder, output_folder, fmt='jsonl', indent=None, processes=None):
+    """Converts every .pckl of input_folder (and the faces/ detection store) to JSON in output_folder.
+
+    fmt 'jsonl' writes one record (frame, scene or track) per line to <name>.jsonl, 'json' writes
+    a JSON array to <name>.json. The files are converted in parallel by up to processes processes
+    (default: one per file, capped at the number of cores).
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt!r}, expected one of {FORMATS}")
     # Create the output folder if it doesn't exist
     os.makedirs(output_folder, exist_ok=True)
 
-    for file_name in os.listdir(input_folder):
+    # the faces/ store supersedes a legacy faces.pckl left in the folder, like in load_detections;
+    # converting both would write faces.<fmt> twice, in parallel
+    has_store = os.path.isdir(os.path.join(input_folder, STORE_NAME))
+    tasks = []
+    for file_name in sorted(os.listdir(input_folder)):
+        if has_store and file_name == f"{STORE_NAME}.pckl":
+            continue
         if file_name.endswith('.pckl'):  # Process only pickle files
             input_path = os.path.join(input_folder, file_name)
-            output_path = os.path.join(output_folder, f"{os.path.splitext(file_name)[0]}.json")
+            output_path = os.path.join(output_folder, f"{os.path.splitext(file_name)[0]}.{fmt}")
+            tasks.append((file_name, convert_pickle, (input_path, output_path, fmt, indent)))
 
-            try:
-                # Load pickle file
-                with open(input_path, 'rb') as pkl_file:
-                    data = pickle.load(pkl_file)
+    # faces are kept in the columnar store, written out in the same per-frame layout as the old faces.pckl
+    if has_store:
+        output_path = os.path.join(output_folder, f"{STORE_NAME}.{fmt}")
+        tasks.append((f"{STORE_NAME}/", convert_detections, (input_folder, output_path, fmt, indent)))
 
-                # Save as JSON
-                with open(output_path, 'w') as json_file:
-                    json.dump(data, json_file, default=custom_serializer, indent=4)
-
-                print(f"Converted {file_name} to JSON.")
-
-            except Exception as e:
-                print(f"Error processing {file_name}: {e}")
+    processes = min(processes or os.cpu_count() or 1, len(tasks))
+    if processes > 1:
+        with ProcessPoolExecutor(processes) as pool:
+            messages = list(pool.map(_convert, tasks))
+    else:
+        messages = [_convert(task) for task in tasks]
+    for message in messages:
+        print(message)
 
 def main():
     # Input and output folders
@@ -47,4 +132,4 @@ def main():
     convert_pickles_to_json(inp, outp)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,173 @@
+import os
+import glob
+import queue
+import threading
+import cv2
+from scenedetect import VideoStreamCv2, SceneManager, StatsManager
+from scenedetect.detectors import ContentDetector
+
+
+def iter_video_frames(video_path, frame_step=1, save_dir=None, start=0):
+    """Decodes a video straight into memory and yields (frame_idx, BGR frame) for every frame_step-th frame.
+
+    frame_idx is the index in the source video. Skipped frames, and all frames before start,
+    are only grabbed, not converted.
+    If save_dir is given the yielded frames are also written there as %06d.jpg (for debugging).
+    """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise ValueError(f"Could not open video: {video_path}")
+    if save_dir is not None:
+        os.makedirs(save_dir, exist_ok=True)
+
+    frame_idx = 0
+    n_saved = len(range(0, start, frame_step))
+    try:
+        while True:
+            if frame_idx % frame_step or frame_idx < start:
+                if not cap.grab():
+                    break
+                frame_idx += 1
+                continue
+
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if save_dir is not None:
+                n_saved += 1
+                cv2.imwrite(os.path.join(save_dir, '%06d.jpg' % n_saved), frame)
+            yield frame_idx, frame
+            frame_idx += 1
+    finally:
+        cap.release()
+
+
+def make_scene_manager():
+    """SceneManager with the ContentDetector settings used for scene.pckl."""
+    scene_manager = SceneManager(StatsManager())
+    scene_manager.add_detector(ContentDetector())
+    return scene_manager
+
+
+class TeeVideoStream(object):
+    """Wraps a scenedetect VideoStream and hands every frame_step-th decoded frame to a callback.
+
+    Everything else is delegated to the wrapped stream, so a SceneManager can read from it as usual.
+    """
+
+    def __init__(self, video, frame_step, on_frame):
+        self._video = video
+        self._frame_step = frame_step
+        self._on_frame = on_frame
+
+    def read(self, decode=True):
+        frame = self._video.read(decode=decode)
+        if decode and frame is not False:
+            frame_idx = self._video.frame_number - 1
+            if frame_idx % self._frame_step == 0:
+                self._on_frame(frame_idx, frame)
+        return frame
+
+    def __getattr__(self, name):
+        return getattr(self._video, name)
+
+
+def iter_video_frames_with_scenes(video_path, scene_manager, frame_step=1, save_dir=None, queue_size=64):
+    """Decodes a video once, feeding every frame to scene_manager and yielding the sampled ones.
+
+    Yields (frame_idx, BGR frame) like iter_video_frames. Scene detection runs in a background
+    thread on the same decode, so once the generator is exhausted scene_manager.get_scene_list()
+    holds the scenes of the whole video. queue_size bounds the decoded frames waiting for the consumer.
+    """
+    if save_dir is not None:
+        os.makedirs(save_dir, exist_ok=True)
+
+    frames = queue.Queue(queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                frames.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def detect_scenes():
+        try:
+            video = TeeVideoStream(VideoStreamCv2(video_path), frame_step, lambda *item: put(item))
+            scene_manager.detect_scenes(video=video)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            put(None)
+
+    thread = threading.Thread(target=detect_scenes, daemon=True)
+    thread.start()
+
+    n_saved = 0
+    try:
+        while True:
+            item = frames.get()
+            if item is None:
+                break
+            if save_dir is not None:
+                n_saved += 1
+                cv2.imwrite(os.path.join(save_dir, '%06d.jpg' % n_saved), item[1])
+            yield item
+    finally:
+        # also reached when the consumer stops early, the decode thread must not block on a full queue
+        stop.set()
+        scene_manager.stop()
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+def iter_frame_paths(frames_dir):
+    """Yields (frame_idx, path) for the extracted *.jpg frames of a folder, leaving the decoding to the caller."""
+    flist = sorted(glob.glob(os.path.join(frames_dir, '*.jpg')))
+    for frame_idx, fname in enumerate(flist):
+        yield frame_idx, fname
+
+
+def video_fps(video_path):
+    """Frame rate from the video metadata, None if the container doesn't report one."""
+    cap = cv2.VideoCapture(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    cap.release()
+    return fps if fps > 0 else None
+
+
+def video_frame_count(video_path):
+    """Frame count from the video metadata, 0 if the video can't be opened. Containers may get it slightly wrong."""
+    cap = cv2.VideoCapture(video_path)
+    count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) if cap.isOpened() else 0
+    cap.release()
+    return max(count, 0)
+
+
+def sample_frames(video_path, n_frames):
+    """Up to n_frames BGR frames spread evenly over the video, seeking to each one."""
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise ValueError(f"Could not open video: {video_path}")
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    frames = []
+    for frame_idx in sorted(set(int((k + 0.5) * total / n_frames) for k in range(n_frames))):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+        ret, frame = cap.read()
+        if ret:
+            frames.append(frame)
+    cap.release()
+    return frames
+
+
+def frame_step_for_rate(video_path, frame_rate):
+    """Frame step that samples a video at roughly frame_rate frames per second."""
+    fps = video_fps(video_path)
+    if fps is None:
+        return 1
+    return max(1, int(round(fps / frame_rate)))